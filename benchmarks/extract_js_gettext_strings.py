@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark the JavaScript gettext extractor on synthetic corpora::
+
+    python3 benchmarks/extract_js_gettext_strings.py
+    python3 benchmarks/extract_js_gettext_strings.py --size 2000 --density 5
+    python3 benchmarks/extract_js_gettext_strings.py --save baseline.json
+    python3 benchmarks/extract_js_gettext_strings.py --baseline baseline.json
+
+The corpora contain ordinary code with comments, template literals with
+nested substitutions, TypeScript declarations and minified single-line
+bundles. Throughput (MB/s) and peak memory are reported per corpus and
+function. With ``--baseline`` the script exits with status 1 if anything got
+slower or hungrier than the tolerance allows.
+"""
+
+import argparse
+import json
+import random
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+
+# Import the extractor as a standalone module, importing the fh_fablib
+# package requires a fabfile.
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "fh_fablib"))
+
+import extract_js_gettext_strings as extractor
+
+
+WORDS = [
+    "alpha",
+    "beta",
+    "gamma",
+    "delta",
+    "epsilon",
+    "zeta",
+    "eta",
+    "theta",
+    "iota",
+    "kappa",
+    "lambda",
+]
+FUNCTIONS = {
+    "strip_comments": extractor.strip_comments,
+    "gettext_calls": lambda source: list(extractor.gettext_calls(source)),
+}
+
+
+def _message(rng):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 6)))
+
+
+def _call(rng):
+    return rng.choice(
+        [
+            lambda: f"gettext('{_message(rng)}')",
+            lambda: f'gettext("{_message(rng)}")',
+            lambda: f"ngettext('{_message(rng)}', '{_message(rng)}', count)",
+            lambda: f"pgettext('ctx', '{_message(rng)}')",
+            lambda: f"interpolate(gettext('%s {_message(rng)}'), [name])",
+        ]
+    )()
+
+
+def _code(rng):
+    return rng.choice(
+        [
+            lambda: f"const {rng.choice(WORDS)} = {rng.randint(0, 999)} / total",
+            lambda: f'fetch("https://example.com/{rng.choice(WORDS)}")',
+            lambda: f"if (/[a-z]+\\/'/.test(value)) {{ count += {rng.randint(1, 9)} }}",
+            lambda: f"element.classList.toggle('{rng.choice(WORDS)}', flag)",
+            lambda: f"items.map((item) => ({{ ...item, {rng.choice(WORDS)}: null }}))",
+        ]
+    )()
+
+
+def _comment(rng):
+    return rng.choice(
+        [
+            lambda: f"// {_message(rng)} gettext('{_message(rng)}')",
+            lambda: (
+                f"/**\n * {_message(rng)}\n * @example gettext(\n *   '{_message(rng)}',\n * )\n */"
+            ),
+        ]
+    )()
+
+
+def _template(rng):
+    return (
+        f'html = `<div class="{rng.choice(WORDS)}">'
+        f"${{items.map((item) => `<li>${{{_call(rng)}}} ${{item.{rng.choice(WORDS)}}}</li>`).join('')}}"
+        f"</div>`"
+    )
+
+
+def _declaration(rng):
+    return rng.choice(
+        [
+            lambda: "declare function gettext(message: string): string",
+            lambda: (
+                "declare function ngettext(\n  singular: string,\n  plural: string,\n  count: number,\n): string"
+            ),
+            lambda: (
+                f"interface {rng.choice(WORDS).title()} {{ {rng.choice(WORDS)}: Array<string> }}"
+            ),
+            lambda: f"export const {rng.choice(WORDS)} = <T,>(value: T): T => value",
+        ]
+    )()
+
+
+GENERATORS = {
+    "code": [_code, _code, _code, _comment],
+    "templates": [_code, _template, _comment],
+    "typescript": [_code, _declaration, _comment],
+}
+
+
+def generate(kind, *, size, density, rng):
+    """Return a source of roughly ``size`` bytes with ``density`` gettext
+    calls per kilobyte"""
+    minified = kind == "minified"
+    generators = GENERATORS["templates" if minified else kind]
+    lines = []
+    length = calls = 0
+    while length < size:
+        if calls < density * length / 1024:
+            line = f"x = {_call(rng)}"
+            calls += 1
+        else:
+            line = rng.choice(generators)(rng)
+            if minified and line.startswith(("//", "/*")):
+                continue
+        lines.append(line)
+        length += len(line) + 2
+    return ";".join(lines) if minified else ";\n".join(lines)
+
+
+def measure(function, sources, *, repeat):
+    total = sum(len(source.encode()) for source in sources)
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for source in sources:
+            function(source)
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    for source in sources:
+        function(source)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {"mb_per_s": total / 1e6 / best, "peak_kb": peak / 1024}
+
+
+def compare(results, baseline, *, tolerance):
+    failures = []
+    for key, result in results.items():
+        if not (base := baseline.get(key)):
+            continue
+        if result["mb_per_s"] < base["mb_per_s"] * (1 - tolerance):
+            failures.append(
+                f"{key}: {result['mb_per_s']:.1f} MB/s,"
+                f" baseline {base['mb_per_s']:.1f} MB/s"
+            )
+        if result["peak_kb"] > base["peak_kb"] * (1 + tolerance):
+            failures.append(
+                f"{key}: {result['peak_kb']:.0f} KiB peak,"
+                f" baseline {base['peak_kb']:.0f} KiB"
+            )
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("::")[0].strip())
+    parser.add_argument("--files", type=int, default=50, help="Files per corpus")
+    parser.add_argument("--size", type=int, default=20_000, help="Bytes per file")
+    parser.add_argument(
+        "--density", type=float, default=2.0, help="gettext calls per kilobyte"
+    )
+    parser.add_argument(
+        "--kinds",
+        default="code,templates,typescript,minified",
+        help="Comma-separated corpora",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--save", type=Path, help="Write results to this file")
+    parser.add_argument("--baseline", type=Path, help="Compare with this file")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Allowed relative regression (default: 0.2)",
+    )
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    results = {}
+    for kind in args.kinds.split(","):
+        sources = [
+            generate(kind, size=args.size, density=args.density, rng=rng)
+            for _ in range(args.files)
+        ]
+        for name, function in FUNCTIONS.items():
+            result = measure(function, sources, repeat=args.repeat)
+            results[f"{kind}/{name}"] = result
+            print(
+                f"{kind + '/' + name:36} {result['mb_per_s']:8.1f} MB/s"
+                f" {result['peak_kb']:10.0f} KiB peak"
+            )
+
+    if args.save:
+        args.save.write_text(json.dumps(results, indent=2) + "\n")
+
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text())
+        if failures := compare(results, baseline, tolerance=args.tolerance):
+            print("\nRegressions:", *failures, sep="\n  ", file=sys.stderr)
+            sys.exit(1)
+        print("\nNo regressions.")
+
+
+if __name__ == "__main__":
+    main()
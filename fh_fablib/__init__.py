@@ -1,9 +1,21 @@
+import atexit
+import concurrent.futures
+import contextlib
+import fnmatch
+import functools
+import gzip
+import hashlib
+import importlib.util
 import inspect
 import io
+import json
 import os
+import queue
 import random
 import re
+import shlex
 import shutil
+import subprocess
 import sys
 
 # https://github.com/BradleyKirton/invoke/commit/dedac9a9807b973e4fa615c413f8bb59a869ebdf
@@ -11,14 +23,20 @@ import sys
 # values on some platforms; gate on the presence of "h" in bytecode constants so
 # the patch silently becomes a no-op once upstream ships the fix.
 import sys as _sys
+import tarfile
 import tempfile
+import textwrap
+import threading
+import time
 import uuid
 import warnings
 from pathlib import Path
 
 import speckenv
-from fabric import Connection, task
+from fabric import Connection, task as _fabric_task
 from invoke import Collection  # noqa: F401
+from invoke.exceptions import Failure
+from invoke.tasks import Task
 from speckenv_django import django_database_url
 
 
@@ -60,7 +78,16 @@ if _sys.platform != "win32":
             stacklevel=2,
         )
 
-from fh_fablib.extract_js_gettext_strings import generate_strings
+from fh_fablib.extract_js_gettext_strings import (
+    JS_PATTERNS,
+    calls_by_file,
+    ensure_cache_dir,
+    file_calls,
+    generate_pot,
+    js_files,
+    sort_calls,
+    tracked_blobs,
+)
 
 
 __version__ = "1.0.20260817"
@@ -149,6 +176,95 @@ def require(version):
                 )
 
 
+#: Path of the Chrome trace file written at exit, enables the trace
+_TRACE = os.environ.get("FL_TRACE")
+_trace_events = []
+_trace_lanes = {}
+_trace_lock = threading.Lock()
+
+
+def _trace_record(name, category, start, end, *, lane=None, **args):
+    with _trace_lock:
+        lane = _trace_lanes.setdefault(
+            lane or threading.get_ident(), len(_trace_lanes) + 1
+        )
+        _trace_events.append(
+            {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": start * 1e6,
+                "dur": (end - start) * 1e6,
+                "pid": os.getpid(),
+                "tid": lane,
+                "args": args,
+            }
+        )
+
+
+@contextlib.contextmanager
+def _traced(name, category, **args):
+    """Record the duration of the block in the timing trace if ``FL_TRACE``
+    is set; the yielded dict may be updated with additional arguments"""
+    if not _TRACE:
+        yield args
+        return
+    start = time.time()
+    try:
+        yield args
+    finally:
+        _trace_record(name, category, start, time.time(), **args)
+
+
+@atexit.register
+def _write_trace():
+    if not _TRACE or not _trace_events:
+        return
+    Path(_TRACE).write_text(
+        json.dumps({"traceEvents": _trace_events, "displayTimeUnit": "ms"})
+    )
+    print(f"\nSlowest steps (trace written to {_TRACE}):", file=sys.stderr)
+    for event in sorted(_trace_events, key=lambda event: -event["dur"])[:15]:
+        print(
+            f"{event['dur'] / 1e6:9.2f}s  {event['cat']:8}"
+            f" {textwrap.shorten(event['name'], 100, placeholder='…')}",
+            file=sys.stderr,
+        )
+
+
+def _traced_task(fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with _traced(fn.__name__, "task"):
+            return fn(*args, **kwargs)
+
+    return wrapper
+
+
+def task(*args, **kwargs):
+    """``fabric.task`` which records the task in the timing trace"""
+    if len(args) == 1 and callable(args[0]) and not isinstance(args[0], Task):
+        return _fabric_task(_traced_task(args[0]), **kwargs)
+    return lambda fn: _fabric_task(*args, **kwargs)(_traced_task(fn))
+
+
+def _run_traced(c, category, *a, **kw):
+    with _traced(" ".join(str(part) for part in a), category) as trace:
+        result = None
+        try:
+            result = c.run(*a, **kw)
+        except Failure as exc:
+            result = exc.result
+            raise
+        finally:
+            if result is not None:
+                trace.update(
+                    exited=result.exited,
+                    output=len(result.stdout) + len(result.stderr),
+                )
+        return result
+
+
 def run(c, *a, **kw):
     """A Context.run or Connection.run with better defaults"""
     kw.setdefault("pty", False)
@@ -159,18 +275,81 @@ def run(c, *a, **kw):
             "PATH": "/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin:/usr/games:/usr/local/games:/snap/bin:~/.local/bin",
         },
     )
+    if threading.current_thread() is not threading.main_thread():
+        kw.setdefault("in_stream", False)
     if not kw.get("hide"):
         progress(" ".join(str(part) for part in a))
-    return c.run(*a, **kw)
+    return _run_traced(c, f"run {getattr(c, 'host', 'local')}", *a, **kw)
 
 
 def run_local(c, *a, **kw):
     """A Context.run for local execution with better defaults"""
     kw.setdefault("pty", True)
     kw.setdefault("replace_env", False)
+    if threading.current_thread() is not threading.main_thread():
+        kw.setdefault("in_stream", False)
     if not kw.get("hide"):
         progress(" ".join(str(part) for part in a))
-    return c.run(*a, **kw)
+    return _run_traced(c, "local", *a, **kw)
+
+
+class _PrefixedStream:
+    """File-like object writing complete lines with a prefix to ``stream``"""
+
+    _lock = threading.Lock()
+
+    def __init__(self, prefix, stream):
+        self.prefix = prefix
+        self.stream = stream
+        self.buffer = ""
+
+    def write(self, data):
+        *lines, self.buffer = (self.buffer + data).split("\n")
+        if lines:
+            with self._lock:
+                self.stream.writelines(f"{self.prefix}{line}\n" for line in lines)
+                self.stream.flush()
+
+    def flush(self):
+        # Invoke flushes after every chunk, which may end mid-line.
+        self.stream.flush()
+
+    def close(self):
+        """Write the last line even if it isn't terminated"""
+        if self.buffer:
+            self.write("\n")
+
+
+def run_many(c, cmds, **kw):
+    """Run several commands at once, each in its own channel of the same
+    connection
+
+    ``cmds`` is a list of commands or a dict of ``{label: command}``. Output
+    lines are prefixed with the label (the command itself by default).
+    Returns the results in the same order as the commands.
+    """
+    if isinstance(cmds, dict):
+        cmds = list(cmds.items())
+    else:
+        cmds = [(textwrap.shorten(cmd, 30, placeholder="…"), cmd) for cmd in cmds]
+
+    def run_one(label, cmd):
+        # Invoke writes to explicitly passed streams even if hide is set.
+        if kw.get("hide"):
+            return run(c, cmd, **kw)
+        streams = {
+            "out_stream": _PrefixedStream(f"[{label}] ", sys.stdout),
+            "err_stream": _PrefixedStream(f"[{label}] ", sys.stderr),
+        }
+        try:
+            return run(c, cmd, **streams, **kw)
+        finally:
+            for stream in streams.values():
+                stream.close()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(cmds) or 1) as pool:
+        futures = [pool.submit(run_one, label, cmd) for label, cmd in cmds]
+    return [future.result() for future in futures]
 
 
 class Config:
@@ -209,12 +388,42 @@ config.update(
     python="3.12",
     _uv_project=(_base / "uv.lock").exists(),
     _mise=shutil.which("mise"),
+    # All tracked files except for the backend's: bundlers also depend on
+    # images, fonts, JSON and various dotfiles.
+    frontend_inputs=[
+        ".",
+        ":(exclude)static",
+        ":(exclude)*.py",
+        ":(exclude)*.html",
+        ":(exclude)*.po",
+        ":(exclude)*.mo",
+        ":(exclude)*.md",
+        ":(exclude)*.rst",
+        ":(exclude)uv.lock",
+        ":(exclude)pyproject.toml",
+        ":(exclude)requirements*.txt",
+    ],
+    build_cache_keep=3,
+    static_upload="manifest",
+    static_manifests_keep=5,
+    precompress=["gz", "br"],
+    socket_activation=False,
+    ready_timeout=120,
+    warmup_urls=["/"],
+    gunicorn={},
+    releases=False,
+    releases_keep=5,
+    uv_cache="~/.cache/uv",
 )
 os.chdir(config.base)
 
 
+_environment_aliases = {}
+
+
 def environment(name, cfg, **kwargs):
     config.environments[name] = cfg
+    _environment_aliases.update(dict.fromkeys(kwargs.get("aliases", ()), name))
 
     if name in kwargs.get("aliases", ()):
         terminate(f"Remove {name} from the aliases list of the {name} environment.")
@@ -228,12 +437,71 @@ def environment(name, cfg, **kwargs):
     return fn
 
 
+_connections = {}
+_connections_lock = threading.RLock()
+
+
 class Connection(Connection):
-    """Connection subclass which always forwards the agent by default"""
+    """Connection subclass which always forwards the agent by default
+
+    Connections to the same host share one SSH client, so that all tasks of
+    one ``fl`` invocation reuse the same authenticated transport. Leaving the
+    ``with`` block only closes SFTP sessions, the clients are closed at exit.
+    """
 
     def __init__(self, *args, **kwargs):
         kwargs.setdefault("forward_agent", True)
         super().__init__(*args, **kwargs)
+        with _connections_lock:
+            self.client = _connections.setdefault(
+                (self.user, self.host, self.port), self.client
+            )
+
+    def open(self):
+        with _connections_lock:
+            transport = self.client.get_transport()
+            if transport is not None and transport.active:
+                self.transport = transport
+                return None
+            with _traced(f"connect {self.host}", "ssh"):
+                return super().open()
+
+    def close(self):
+        if self._sftp is not None:
+            self._sftp.close()
+            self._sftp = None
+        if self._agent_handler is not None:
+            self._agent_handler.close()
+            self._agent_handler = None
+
+
+_SSH_CONTROL_PATH = f"/tmp/fl-{os.getpid()}-%C"
+_ssh_hosts = set()
+
+
+def _ssh(host):
+    """Return the ssh command for subprocesses such as rsync or git
+
+    All of them share one OpenSSH master connection per host which is
+    stopped when ``fl`` exits.
+    """
+    _ssh_hosts.add(host)
+    return (
+        "ssh -o ControlMaster=auto"
+        f" -o ControlPath={_SSH_CONTROL_PATH} -o ControlPersist=60"
+    )
+
+
+@atexit.register
+def _close_connections():
+    for client in _connections.values():
+        client.close()
+    for host in _ssh_hosts:
+        subprocess.run(
+            ["ssh", "-O", "exit", "-o", f"ControlPath={_SSH_CONTROL_PATH}", host],
+            capture_output=True,
+            check=False,
+        )
 
 
 def _random_string(length, *, chars=None):
@@ -258,6 +526,38 @@ def _dsn_from_database_url(url):
 
 
 def _concurrently(ctx, jobs):
+    """Run shell commands concurrently; each of them gets its own lane in
+    the timing trace"""
+    if not _TRACE:
+        _concurrently_systemd(ctx, jobs)
+        return
+
+    start = time.time()
+    # date +%N is GNU only.
+    now = f"{shlex.quote(sys.executable)} -c 'import time; print(time.time())'"
+    with tempfile.NamedTemporaryFile("r", prefix="fl.", suffix=".times") as times:
+        try:
+            _concurrently_systemd(
+                ctx,
+                [
+                    f"( {job}; rc=$?; echo {i} $({now}) $rc >> {times.name} )"
+                    for i, job in enumerate(jobs)
+                ],
+            )
+        finally:
+            ended = {}
+            for line in times:
+                with contextlib.suppress(ValueError):
+                    i, end, rc = line.split()
+                    ended[int(i)] = (float(end), int(rc))
+            for i, job in enumerate(jobs):
+                end, rc = ended.get(i, (time.time(), None))
+                _trace_record(
+                    job, "local", start, end, lane=f"concurrently-{i}", exited=rc
+                )
+
+
+def _concurrently_systemd(ctx, jobs):
     # Check if systemd is available
     try:
         run_local(ctx, "systemctl --user --version", hide=True)
@@ -394,7 +694,7 @@ def pull_db(ctx, extra_dump_args=""):
     run_local(ctx, f"createdb {dbname}")
     run_local(
         ctx,
-        f"ssh {config.host} -C 'pg_dump -Ox {srv_dsn} {extra_dump_args}' | psql {local_dsn}",
+        f"{_ssh(config.host)} {config.host} -C 'pg_dump -Ox {srv_dsn} {extra_dump_args}' | psql {local_dsn}",
     )
 
     reset_pw(ctx)
@@ -405,7 +705,11 @@ def pull_media(ctx, folder="media"):
     """Rsync a folder from the remote to the local environment"""
     flags = "-pthrz --stats"
     folder = folder.strip("/")
-    run_local(ctx, f"rsync {flags} {config.host}:{config.domain}/{folder}/ {folder}/")
+    run_local(
+        ctx,
+        f"rsync {flags} -e '{_ssh(config.host)}'"
+        f" {config.host}:{config.domain}/{folder}/ {folder}/",
+    )
 
 
 @task
@@ -464,7 +768,8 @@ def _srv_env(conn, path):
 
     with tempfile.NamedTemporaryFile() as f:
         try:
-            conn.get(path, f.name)
+            with _traced(f"get {conn.host}:{path}", "ssh"):
+                conn.get(path, f.name)
         except OSError as exc:
             terminate(f"Unable to read {conn.host}:{path}: {exc}")
 
@@ -473,44 +778,363 @@ def _srv_env(conn, path):
     return lambda *a, **kw: speckenv.env(*a, **kw, mapping=mapping)
 
 
+def _write_if_changed(path, content):
+    """Atomically replace the file at ``path`` with ``content`` unless it has
+    exactly that content already; returns whether the file was written"""
+    path = Path(path)
+    try:
+        if path.read_text(encoding="utf-8") == content:
+            return False
+        mode = path.stat().st_mode
+    except FileNotFoundError:
+        mode = 0o644
+    with tempfile.NamedTemporaryFile(
+        "w", encoding="utf-8", dir=path.parent, prefix=f".{path.name}.", delete=False
+    ) as f:
+        f.write(content)
+    os.chmod(f.name, mode)
+    os.replace(f.name, path)
+    return True
+
+
+def _strings_js(by_file):
+    return "".join(
+        f"{string}\n"
+        for string in sort_calls({c for calls in by_file.values() for c in calls})
+    )
+
+
+def _djangojs_state(strings, language, *, pot):
+    """Hash everything the djangojs catalogs are generated from"""
+    state = [language, pot, strings, sorted(tracked_blobs(*JS_PATTERNS))]
+    return hashlib.sha256(json.dumps(state).encode()).hexdigest()
+
+
+def _po_files(ctx):
+    """Return all catalogs which aren't ignored by git"""
+    files = run_local(
+        ctx,
+        "git ls-files -z --cached --others --exclude-standard -- '*/LC_MESSAGES/*.po'",
+        hide=True,
+    ).stdout.split("\0")
+    return [Path(file) for file in files if file]
+
+
+def _locale_dirs(ctx):
+    """Return ``{locale dir: languages}`` for all folders containing catalogs"""
+    dirs = {}
+    for path in _po_files(ctx):
+        dirs.setdefault(path.parents[2], set()).add(path.parents[1].name)
+    return dirs
+
+
+def _untracked_dirs(ctx):
+    """Return ``-i`` arguments for makemessages and compilemessages which
+    prune all untracked and ignored directories from their walk
+
+    Directories are passed by name if no tracked directory has the same
+    name, so that e.g. all ``__pycache__`` folders only need one argument,
+    and by path otherwise. Django also matches paths against the name of
+    each directory, so top-level directories whose name is used by a tracked
+    directory are walked. Folders containing catalogs or ``conf/strings.js``
+    are kept.
+    """
+    tracked = {
+        parent
+        for file in run_local(ctx, "git ls-files -z", hide=True).stdout.split("\0")
+        if file
+        for parent in Path(file).parents
+    }
+    keep = {*_locale_dirs(ctx), Path("conf/strings.js")}
+    untracked = [
+        Path(directory)
+        for directory in run_local(
+            ctx, "git ls-files -z --others --directory --no-empty-directory", hide=True
+        ).stdout.split("\0")
+        if directory.endswith("/")
+    ]
+    names = {directory.name for directory in tracked}
+    patterns = {
+        directory.name if directory.name not in names else str(directory)
+        for directory in untracked
+        if not any(directory in path.parents or directory == path for path in keep)
+        and (directory.name not in names or len(directory.parts) > 1)
+    }
+    return " ".join(f"-i {shlex.quote(pattern)}" for pattern in sorted(patterns))
+
+
+def _write_djangojs_catalogs(ctx, language, by_file):
+    """Write the djangojs catalogs using the calls found by the extractor
+    instead of letting makemessages walk the tree and run xgettext again"""
+    if not (dirs := _locale_dirs(ctx)):
+        terminate("No locale folders found, run fl mm without --pot once.")
+
+    def locale_dir(path):
+        # The deepest locale folder whose parent contains the file, the
+        # same rule makemessages uses.
+        parents = Path(path).parents
+        return max(
+            (directory for directory in dirs if directory.parent in parents),
+            key=lambda directory: len(directory.parts),
+            default=None,
+        )
+
+    default = locale_dir("conf/strings.js") or min(dirs)
+    grouped = {}
+    for path, calls in by_file.items():
+        grouped.setdefault(locale_dir(path) or default, {})[path] = calls
+
+    creation_date = time.strftime("%Y-%m-%d %H:%M%z")
+    for directory, files in sorted(grouped.items()):
+        pot = directory / "djangojs.pot"
+        pot.write_text(
+            generate_pot(files, creation_date=creation_date), encoding="utf-8"
+        )
+        try:
+            for lang in [language] if language else sorted(dirs[directory]):
+                po = directory / lang / "LC_MESSAGES" / "djangojs.po"
+                if po.exists():
+                    run_local(
+                        ctx,
+                        "msgmerge -q --backup=none --previous --update --no-wrap"
+                        f" --add-location=file {po} {pot}",
+                    )
+                else:
+                    # msginit fills in the Plural-Forms header of the
+                    # language, makemessages copies it from Django's catalogs.
+                    po.parent.mkdir(parents=True, exist_ok=True)
+                    run_local(
+                        ctx,
+                        f"msginit --no-translator --no-wrap -l {lang} -i {pot} -o {po}",
+                        hide=True,
+                    )
+        finally:
+            pot.unlink()
+
+
+def _makemessages_djangojs(ctx, language, by_file, *, incremental=False, pot=False):
+    strings = _strings_js(by_file)
+    stamp = ensure_cache_dir() / "mm-djangojs.stamp"
+    state = _djangojs_state(strings, language, pot=pot)
+    if incremental and stamp.exists() and stamp.read_text() == state:
+        progress("Skipping the djangojs catalogs, no JavaScript changed")
+        return
+
+    if pot:
+        _write_djangojs_catalogs(ctx, language, by_file)
+    else:
+        run_local(
+            ctx,
+            f"{config._manage()} makemessages {f'-l {language}' if language else '-a'}"
+            f" --add-location file {_untracked_dirs(ctx)} --no-wrap -d djangojs",
+            replace_env=False,
+        )
+    _write_if_changed(stamp, state)
+
+
+_WATCH_EXCLUDE = r"(^|/)(\.git|\.venv|venv|node_modules|\.cache|static|media|tmp)(/|$)"
+
+
+def _watch_files(patterns, *, interval=1.0):
+    """Yield sets of paths matching ``patterns`` which have been changed,
+    created or deleted, or an empty set if nothing happened for ``interval``
+    seconds
+
+    Uses ``inotifywait`` from inotify-tools if available and polls the
+    modification times of tracked files otherwise.
+    """
+    watch = _watch_files_inotify if shutil.which("inotifywait") else _watch_files_poll
+    for changed in watch(interval=interval):
+        yield {
+            path
+            for path in changed
+            if any(fnmatch.fnmatch(path, pattern) for pattern in patterns)
+        }
+
+
+def _watch_files_inotify(*, interval):
+    process = subprocess.Popen(
+        [
+            "inotifywait",
+            "--monitor",
+            "--recursive",
+            "--quiet",
+            "--event=close_write,moved_to,moved_from,delete",
+            "--format=%w%f",
+            f"--exclude={_WATCH_EXCLUDE}",
+            ".",
+        ],
+        stdout=subprocess.PIPE,
+        encoding="utf-8",
+    )
+    events = queue.Queue()
+
+    def read():
+        for line in process.stdout:
+            events.put(os.path.normpath(line.rstrip("\n")))
+
+    threading.Thread(target=read, daemon=True).start()
+    try:
+        while True:
+            changed = set()
+            try:
+                changed.add(events.get(timeout=interval))
+                # Collect the whole burst of events caused by one save
+                while True:
+                    changed.add(events.get(timeout=0.05))
+            except queue.Empty:
+                pass
+            yield changed
+    finally:
+        process.terminate()
+
+
+def _watch_files_poll(*, interval):
+    def snapshot():
+        mtimes = {}
+        for path in js_files():
+            with contextlib.suppress(FileNotFoundError):
+                mtimes[path] = os.stat(path).st_mtime_ns
+        return mtimes
+
+    before = snapshot()
+    while True:
+        time.sleep(interval)
+        after = snapshot()
+        yield {
+            path
+            for path in before.keys() | after.keys()
+            if before.get(path) != after.get(path)
+        }
+        before = after
+
+
+def _mm_watch(ctx, language, *, debounce=2.0, pot=False):
+    by_file = calls_by_file()
+    pending = None  # Time of the last change not yet seen by makemessages
+
+    progress("Watching JavaScript files for changes, press Ctrl-C to stop...")
+    for changed in _watch_files(JS_PATTERNS, interval=0.5):
+        if changed:
+            tracked = set(js_files())
+            for path in changed:
+                exists = path in tracked and os.path.exists(path)
+                calls = file_calls(path) if exists else []
+                if calls != by_file.get(path, []):
+                    by_file[path] = calls
+                    pending = time.monotonic()
+
+            strings = _strings_js(by_file)
+            if _write_if_changed("conf/strings.js", strings):
+                info(f"Updated conf/strings.js ({', '.join(sorted(changed))})")
+            by_file["conf/strings.js"] = strings.splitlines()
+
+        elif pending and time.monotonic() - pending > debounce:
+            _makemessages_djangojs(ctx, language, by_file, pot=pot)
+            pending = None
+
+
 @task(
     auto_shortflags=False,
-    help={"language": "Generate catalogs for a specific language"},
+    help={
+        "language": "Generate catalogs for a specific language",
+        "incremental": "Skip the djangojs catalogs if no JavaScript changed",
+        "watch": "Keep running and update the djangojs catalogs after changes",
+        "pot": "Write the djangojs catalogs directly instead of running xgettext",
+    },
 )
-def mm(ctx, language=None):
+def mm(ctx, language=None, incremental=False, watch=False, pot=False):
     """Update the translation catalogs"""
 
-    with open("conf/strings.js", "w", encoding="utf-8") as f:
-        f.write("".join(f"{string}\n" for string in generate_strings()))
+    by_file = calls_by_file()
+    strings = _strings_js(by_file)
+    _write_if_changed("conf/strings.js", strings)
+    by_file["conf/strings.js"] = strings.splitlines()
 
-    language = f"-l {language}" if language else "-a"
     run_local(
         ctx,
-        f"{config._manage()} makemessages {language} --add-location file"
-        " -i .venv -i htmlcov -i node_modules -i lib -i build -i dist -i tmp --no-wrap",
+        f"{config._manage()} makemessages {f'-l {language}' if language else '-a'}"
+        f" --add-location file {_untracked_dirs(ctx)} --no-wrap",
         replace_env=False,
     )
-    run_local(
-        ctx,
-        f"{config._manage()} makemessages {language} --add-location file"
-        " -i .venv -i htmlcov -i node_modules -i lib -i build -i dist -i tmp --no-wrap"
-        " -d djangojs",
-        replace_env=False,
+    _makemessages_djangojs(
+        ctx, language, by_file, incremental=incremental or watch, pot=pot
     )
 
     if config.traduire:
         warning(f"Attention, this project uses {config.traduire}.")
 
+    if watch:
+        with contextlib.suppress(KeyboardInterrupt):
+            _mm_watch(ctx, language, pot=pot)
 
-@task
-def cm(ctx):
+
+def _file_hash(path):
+    try:
+        return hashlib.sha256(path.read_bytes()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+def _msgfmt(po):
+    mo = po.with_suffix(".mo")
+    result = subprocess.run(
+        ["msgfmt", "--check-format", "-o", mo, po],
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    return result.returncode, result.stderr
+
+
+@task(
+    auto_shortflags=False,
+    help={
+        "force": "Compile all catalogs, even those which are up to date",
+        "jobs": "Number of msgfmt processes to run at once (default: CPU count)",
+    },
+)
+def cm(ctx, force=False, jobs=None):
     """Compile the translation catalogs"""
-    run_local(
-        ctx,
-        f"{config._manage()} compilemessages"
-        " -i .venv -i htmlcov -i node_modules -i lib -i build -i dist",
-        replace_env=False,
+    stamp = ensure_cache_dir() / "cm.json"
+    try:
+        compiled = {} if force else json.loads(stamp.read_text())
+    except (FileNotFoundError, ValueError):
+        compiled = {}
+
+    # Compile catalogs whose .po or .mo changed since the last run.
+    hashes = {str(po): _file_hash(po) for po in _po_files(ctx)}
+    outdated = [
+        Path(po)
+        for po, po_hash in hashes.items()
+        if compiled.get(po) != [po_hash, _file_hash(Path(po).with_suffix(".mo"))]
+    ]
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=int(jobs) if jobs else os.cpu_count()
+    ) as executor:
+        results = dict(zip(outdated, executor.map(_msgfmt, outdated)))
+
+    failed = []
+    for po, (returncode, stderr) in results.items():
+        if stderr:
+            warning(stderr.rstrip())
+        if returncode:
+            failed.append(str(po))
+            compiled.pop(str(po), None)
+        else:
+            compiled[str(po)] = [hashes[str(po)], _file_hash(po.with_suffix(".mo"))]
+
+    _write_if_changed(
+        stamp,
+        json.dumps({po: compiled[po] for po in hashes if po in compiled}, indent=0),
+    )
+    info(
+        f"Compiled {len(outdated) - len(failed)} catalogs,"
+        f" skipped {len(hashes) - len(outdated)} which were up to date."
     )
+    if failed:
+        terminate(f"Compiling {', '.join(failed)} failed.")
 
 
 @task(
@@ -661,17 +1285,34 @@ def nine_alias_remove(ctx, alias, include_www):
             )
 
 
-def _unit(config, *, args=""):
-    # args = " -w 2 --preload"
+def _unit(config, *, args="", limits=""):
+    if config.socket_activation:
+        # gunicorn uses the socket passed by systemd. HUP starts new workers
+        # with the new code and stops the old ones gracefully.
+        bind = ""
+        socket = f"""\
+Requires={config.domain}.socket
+After={config.domain}.socket
+"""
+        reload = "ExecReload=/bin/kill -s HUP $MAINPID\nKillMode=mixed\n"
+    else:
+        bind = f" -b unix:///home/www-data/{config.domain}/tmp/gunicorn.sock"
+        socket = reload = ""
+    root = f"/home/www-data/{config.domain}"
+    if config.releases:
+        # gunicorn changes into the directory for every new worker, so that
+        # reloads pick up the release ``current`` points to.
+        root = f"{root}/current"
+        bind = f"{bind} --chdir {root}"
     return f"""\
 [Unit]
 Description=gunicorn for {config.domain}
-
+{socket}
 [Service]
 Environment=LANG=en_US.UTF-8 LC_ALL=en_US.UTF-8 LC_CTYPE=en_US.UTF-8
-ExecStart=/home/www-data/{config.domain}/{".venv/bin/gunicorn" if config._uv_project else "venv/bin/gunicorn"} wsgi:application -b unix:///home/www-data/{config.domain}/tmp/gunicorn.sock --max-requests 1000 --max-requests-jitter 100 {args}
-SyslogIdentifier=gunicorn:{config.domain}
-WorkingDirectory=/home/www-data/{config.domain}/
+ExecStart={root}/{".venv/bin/gunicorn" if config._uv_project else "venv/bin/gunicorn"} wsgi:application{bind} --max-requests 1000 --max-requests-jitter 100 {args}
+{reload}{limits}SyslogIdentifier=gunicorn:{config.domain}
+WorkingDirectory={root}/
 Restart=always
 
 [Install]
@@ -679,20 +1320,183 @@ WantedBy=default.target
 """
 
 
+def _socket_unit(config):
+    """Return a socket unit which holds gunicorn's listening socket, so that
+    requests queue instead of failing while gunicorn restarts"""
+    return f"""\
+[Unit]
+Description=gunicorn socket for {config.domain}
+
+[Socket]
+ListenStream=/home/www-data/{config.domain}/tmp/gunicorn.sock
+
+[Install]
+WantedBy=sockets.target
+"""
+
+
+def _gunicorn_config(config, *, cpus, memory):
+    """Return the gunicorn arguments and the resource limits for the unit
+    sized for a host with ``cpus`` and ``memory`` (available MiB)
+
+    The hints in ``config.gunicorn`` are ``workload`` (``"io"`` uses threads
+    in fewer workers, ``"cpu"`` more sync workers), ``rss`` (MiB per
+    worker), ``memory_share`` (the share of the available memory this site
+    may use), ``preload`` and ``limits`` (add ``MemoryMax`` and ``CPUQuota``
+    with ``cpu_share`` of the CPUs).
+    """
+    hints = {
+        "workload": "io",
+        "rss": 150,
+        "memory_share": 0.5,
+        "preload": False,
+        "limits": False,
+        "cpu_share": 0.5,
+        **config.gunicorn,
+    }
+    by_memory = max(1, int(memory * hints["memory_share"] / hints["rss"]))
+    if hints["workload"] == "cpu":
+        workers, threads = min(2 * cpus + 1, by_memory), 1
+        args = f"-w {workers}"
+    else:
+        workers, threads = min(cpus + 1, by_memory), 4
+        args = f"-w {workers} -k gthread --threads {threads}"
+    if hints["preload"]:
+        if config.socket_activation:
+            warning("--preload prevents graceful reloads from loading new code.")
+        args += " --preload"
+
+    limits = ""
+    if hints["limits"]:
+        limits = (
+            f"MemoryMax={int(workers * hints['rss'] * 1.5)}M\n"
+            f"CPUQuota={int(cpus * hints['cpu_share'] * 100)}%\n"
+        )
+    info(
+        f"gunicorn for {config.domain}: {workers} {hints['workload']}-bound workers"
+        f" with {threads} threads each ({cpus} CPUs, {memory} MiB available)"
+    )
+    return args, limits
+
+
 @task
 def nine_unit(ctx):
     """Start and enable a gunicorn unit"""
     with Connection(config.host) as conn:
+        cpus, memory = run(
+            conn,
+            "nproc; awk '/MemAvailable/ {print int($2 / 1024)}' /proc/meminfo",
+            hide=True,
+        ).stdout.split()
+        args, limits = _gunicorn_config(config, cpus=int(cpus), memory=int(memory))
         conn.put(
-            io.StringIO(_unit(config)), f".config/systemd/user/{config.domain}.service"
+            io.StringIO(_unit(config, args=args, limits=limits)),
+            f".config/systemd/user/{config.domain}.service",
         )
+        if config.socket_activation:
+            conn.put(
+                io.StringIO(_socket_unit(config)),
+                f".config/systemd/user/{config.domain}.socket",
+            )
         run(conn, "systemctl --user daemon-reload")
+        if config.socket_activation:
+            # gunicorn may still hold the socket itself, the socket unit has to
+            # take over. This restart is the last one with a gap.
+            run(conn, f"systemctl --user stop {config.domain}.service")
+            run(conn, f"rm -f {config.domain}/tmp/gunicorn.sock")
+            run(conn, f"systemctl --user enable --now {config.domain}.socket")
         run(conn, f"systemctl --user enable --now {config.domain}.service")
 
     info("Successfully created the virtual host.\n")
     warning("Please update the hostings overview as well!")
 
 
+def _uv(command):
+    """Return a remote uv command which uses the cache shared by all
+    environments of the host user and hardlinks packages from it"""
+    return f"UV_CACHE_DIR={config.uv_cache} UV_LINK_MODE=hardlink uv {command}"
+
+
+def _nine_cache_warm(ctx):
+    """Prefetch the packages of the local lockfile into the remote uv cache
+
+    The lockfile is synced into a scratch environment in
+    ``tmp/cache-warm/``, so that the following ``uv sync`` of the
+    deployment only has to hardlink the packages. Reports the time taken and
+    the disk space the virtualenvs on the host share through hardlinks.
+    Returns whether warming succeeded.
+    """
+    if not config._uv_project:
+        return False
+    start = time.monotonic()
+    files = [
+        name
+        for name in ["pyproject.toml", "uv.lock", ".python-version"]
+        if (config.base / name).exists()
+    ]
+    with Connection(config.host) as conn:
+        run(conn, f"mkdir -p {config.domain}/tmp/cache-warm", hide=True)
+        for name in files:
+            conn.put(str(config.base / name), f"{config.domain}/tmp/cache-warm/{name}")
+        with conn.cd(f"{config.domain}/tmp/cache-warm"):
+            result = run(
+                conn,
+                _uv(
+                    "sync --frozen --no-dev --no-install-project"
+                    " --no-install-workspace --quiet"
+                ),
+                warn=True,
+            )
+        if result.failed:
+            warning("Warming the uv cache failed, continuing.")
+            return False
+        elapsed = time.monotonic() - start
+        usage = run(
+            conn,
+            "du -skc */.venv */releases/*/.venv 2>/dev/null | tail -n 1;"
+            " du -skc --count-links */.venv */releases/*/.venv 2>/dev/null"
+            " | tail -n 1",
+            hide=True,
+            warn=True,
+        ).stdout.splitlines()
+    info(f"Warmed the uv cache in {elapsed:.1f}s")
+    # du counts hardlinked files once unless --count-links is given.
+    with contextlib.suppress(ValueError):
+        used, linked = (int(line.split()[0]) for line in usage)
+        info(
+            f"Virtualenvs on {config.host} use {used / 1024:.0f} MB,"
+            f" {(linked - used) / 1024:.0f} MB saved by hardlinks"
+        )
+    return True
+
+
+def _cache_warm_step(ctx, warm):
+    """Run ``_nine_cache_warm`` and record when it started and ended in
+    ``warm``"""
+    warm["start"] = time.monotonic()
+    if _nine_cache_warm(ctx):
+        warm["end"] = time.monotonic()
+    else:
+        warm.clear()
+
+
+def _report_cache_warm(warm, start, *, updated):
+    """Report how much of a virtualenv update the cache warm-up saved at
+    least, ``start`` being the start of the step running the update"""
+    if not updated or "start" not in warm:
+        return
+    # uv waits for packages the warm-up is still fetching, only what was
+    # done before the update started has been saved.
+    saved = min(warm.get("end", start), start) - warm["start"]
+    info(f"Warming the uv cache saved at least {max(saved, 0):.1f}s of the update")
+
+
+@task
+def nine_cache_warm(ctx):
+    """Prefetch the lockfile's packages into the server's uv cache"""
+    _nine_cache_warm(ctx)
+
+
 def _nine_has_manage_databases(conn):
     return bool(run(conn, "which nine-manage-databases", warn=True).stdout.strip())
 
@@ -790,16 +1594,73 @@ def nine_ssl(ctx):
         )
 
 
-def _nine_restart(conn):
-    run(conn, f"systemctl --user restart {config.domain}.service")
+def _gunicorn_curl(path):
+    return (
+        "curl -s -o /dev/null -w 'status=%{http_code}' --max-time 30"
+        f" --unix-socket /home/www-data/{config.domain}/tmp/gunicorn.sock"
+        f" -H 'Host: {config.domain}' 'http://{config.domain}{path}'"
+    )
+
+
+def _gunicorn_probe(conn):
+    """Return the gunicorn worker PIDs and the HTTP status of ``/`` requested
+    through the unix socket (0 if it didn't answer)"""
+    result = run(
+        conn,
+        f"pgrep -P $(systemctl --user show -p MainPID --value {config.domain}.service);"
+        f" {_gunicorn_curl('/')}",
+        hide=True,
+        warn=True,
+    ).stdout
+    workers, _, status = result.rpartition("status=")
+    return set(workers.split()), int(status.strip() or 0)
+
+
+def _nine_wait_ready(conn, *, old_workers=(), start=None):
+    """Wait until all gunicorn workers have been replaced and the site
+    answers, then request ``config.warmup_urls`` once per worker"""
+    start = start or time.monotonic()
+    while True:
+        workers, status = _gunicorn_probe(conn)
+        if workers and not workers & set(old_workers) and status // 100 in {2, 3, 4}:
+            break
+        if time.monotonic() - start > config.ready_timeout:
+            terminate(
+                f"{config.domain} isn't ready after {config.ready_timeout}s"
+                f" (status {status}), see journalctl --user -u {config.domain}.service"
+            )
+        time.sleep(0.5)
+    ready = time.monotonic()
+
+    # Concurrent requests are spread across the idle workers.
+    for path in config.warmup_urls:
+        run_many(conn, [_gunicorn_curl(path)] * len(workers), hide=True, warn=True)
+    info(
+        f"{config.domain} was ready after {ready - start:.1f}s, warming up"
+        f" {len(config.warmup_urls)} URLs on {len(workers)} workers took"
+        f" {time.monotonic() - ready:.1f}s"
+    )
+
+
+def _nine_restart(conn, *, ready=True, reload=True):
+    """Restart (or reload, if ``reload`` is set) gunicorn and wait until it's
+    ready"""
+    start = time.monotonic()
+    old_workers = _gunicorn_probe(conn)[0] if ready else ()
+    if config.socket_activation and reload:
+        run(conn, f"systemctl --user reload-or-restart {config.domain}.service")
+    else:
+        run(conn, f"systemctl --user restart {config.domain}.service")
+    if ready:
+        _nine_wait_ready(conn, old_workers=old_workers, start=start)
 
 
 @task
 def nine_restart(ctx):
     """Restart the application server"""
-    with Connection(config.host) as conn, conn.cd(config.domain):
+    with Connection(config.host) as conn, conn.cd(_app_dir()):
         if config._uv_project:
-            run(conn, "uv run --no-dev manage.py check --deploy")
+            run(conn, _uv("run --no-dev manage.py check --deploy"))
         else:
             run(conn, "venv/bin/python manage.py check --deploy")
         _nine_restart(conn)
@@ -812,7 +1673,16 @@ def nine_disable(ctx):
         run(conn, f"sudo nine-manage-vhosts virtual-host remove {config.domain}")
 
         run(conn, f"systemctl --user disable --now {config.domain}.service")
-        run(conn, f"rm -f .config/systemd/user/{config.domain}.service")
+        run(
+            conn,
+            f"systemctl --user disable --now {config.domain}.socket",
+            warn=True,
+        )
+        run(
+            conn,
+            f"rm -f .config/systemd/user/{config.domain}.service"
+            f" .config/systemd/user/{config.domain}.socket",
+        )
         run(conn, "systemctl --user daemon-reload")
 
         e = _srv_env(conn, f"{config.domain}/.env")
@@ -848,7 +1718,7 @@ def nine_venv(ctx, python3="python3"):
     with Connection(config.host) as conn, conn.cd(config.domain):
         if config._uv_project:
             run(conn, "rm -rf venv .venv")
-            run(conn, "uv sync --no-dev")
+            run(conn, _uv("sync --no-dev"))
         else:
             run(conn, "rm -rf venv")
             run(conn, f"PATH=~/.pyenv/shims:$PATH {python3} -m venv venv")
@@ -952,7 +1822,11 @@ def fetch(ctx):
         warn=True,
         hide=True,
     )
-    run_local(ctx, f"git fetch env/{config.remote}")
+    run_local(
+        ctx,
+        f"git fetch env/{config.remote}",
+        env={"GIT_SSH_COMMAND": _ssh(config.host)},
+    )
 
 
 def _check_branch(ctx):
@@ -981,6 +1855,25 @@ def _check_only_uv_venv_if_uv_project(ctx):
                 )
 
 
+def _check_server(ctx):
+    """Run the checks of ``_check_no_uncommitted_changes`` and
+    ``_check_only_uv_venv_if_uv_project`` at once"""
+    progress("Checking the server...")
+    cmds = [f"cd {config.domain} && git status --porcelain"]
+    if config._uv_project:
+        cmds.append(f"test -e {config.domain}/venv")
+    with Connection(config.host) as conn:
+        status, *venv = run_many(conn, cmds, hide=True, warn=True)
+    if status.failed:
+        terminate(f"Checking the status on the server failed: {status.stderr}")
+    if status.stdout.strip():
+        terminate("Terminating because of uncommitted changes on server")
+    if venv and venv[0].ok:
+        terminate(
+            "The project uses uv project management but old 'venv' path still exists"
+        )
+
+
 @task
 def check(ctx):
     """Check the coding style of staged files"""
@@ -992,7 +1885,63 @@ def _deploy_sync_origin_url(ctx, conn):
     run(conn, f"git remote set-url origin {url}")
 
 
-def _deploy_django(conn):
+_DEPENDENCY_FILES = [
+    "uv.lock",
+    "pyproject.toml",
+    ".python-version",
+    "requirements*.txt",
+]
+# Enabling an installed app only changes the settings, but may add
+# migrations and static files.
+_SETTINGS_FILES = ["*settings*.py"]
+
+
+def _changed_files(conn, old, new):
+    """Return the paths changed between two remote commits, or ``None`` if
+    that cannot be determined (e.g. when a submodule changed)"""
+    if not old:
+        return None
+    result = run(conn, f"git diff --raw --no-renames {old} {new}", hide=True, warn=True)
+    if result.failed:
+        return None
+    changed = set()
+    for line in result.stdout.splitlines():
+        modes, _, path = line.partition("\t")
+        if "160000" in modes:
+            return None
+        changed.add(path)
+    return changed
+
+
+def _changes_since_deployed(conn, step):
+    """Return the paths changed since ``step`` last succeeded, see
+    ``_changed_files``"""
+    old = run(conn, f"git config --get fl.deployed-{step}", hide=True, warn=True)
+    changed = _changed_files(conn, old.stdout.strip(), "HEAD")
+    info(
+        f"Changed files since the last {step} step: "
+        + ("unknown, running everything" if changed is None else str(len(changed)))
+    )
+    return changed
+
+
+def _record_deployed(conn, step):
+    run(conn, f"git config fl.deployed-{step} $(git rev-parse HEAD)", hide=True)
+
+
+def _any_changed(changed, *patterns):
+    return changed is None or any(
+        fnmatch.fnmatch(path, pattern) for path in changed for pattern in patterns
+    )
+
+
+def _deploy_django(conn, *, full=True):
+    """Update the checkout and the virtualenv and migrate
+
+    Unless ``full`` is set steps are skipped if the files they depend on
+    didn't change since the last successful run. Returns whether the
+    virtualenv was updated.
+    """
     run(conn, "git fetch origin")
     run(conn, f"git checkout {config.branch}")
 
@@ -1007,73 +1956,778 @@ def _deploy_django(conn):
         for path in ["./venv", "./static", "./media", "./.git", "./node_modules"]
     )
     run(conn, f'find . {skip} -name "*.pyc" -print | xargs rm -f')
-    if config._uv_project:
-        run(conn, "uv sync --no-dev")
-        run(conn, "uv run --no-dev manage.py migrate")
-        run(conn, "uv run --no-dev manage.py check --deploy", warn=True)
+
+    changed = None if full else _changes_since_deployed(conn, "django")
+    venv = ".venv" if config._uv_project else "venv"
+    dependencies = _any_changed(changed, *_DEPENDENCY_FILES)
+    if not dependencies and run(conn, f"test -d {venv}", hide=True, warn=True).failed:
+        dependencies = True
+
+    if not dependencies:
+        progress("Skipping the virtualenv update, dependencies didn't change")
+    elif config._uv_project:
+        run(conn, _uv("sync --no-dev"))
     else:
         run(conn, "venv/bin/python -m pip install -U pip")
         run(conn, "venv/bin/python -m pip install -r requirements.txt")
-        run(conn, "venv/bin/python manage.py migrate")
-        run(conn, "venv/bin/python manage.py check --deploy", warn=True)
 
+    manage = (
+        _uv("run --no-dev manage.py")
+        if config._uv_project
+        else "venv/bin/python manage.py"
+    )
+    if dependencies or _any_changed(changed, "*/migrations/*.py", *_SETTINGS_FILES):
+        run(conn, f"{manage} migrate")
+    else:
+        progress("Skipping migrate, no migrations changed")
+    if dependencies or _any_changed(changed, "*.py"):
+        run(conn, f"{manage} check --deploy", warn=True)
+    else:
+        progress("Skipping check --deploy, no Python files changed")
+    _record_deployed(conn, "django")
+    return dependencies
+
+
+_RELEASE_SHARED = [".env", "media", "static", "tmp"]
+
+
+def _app_dir():
+    """Return the remote directory of the live code"""
+    return f"{config.domain}/current" if config.releases else config.domain
+
+
+def _current_release(conn):
+    """Return the name of the release ``current`` points to, or ``""``"""
+    target = run(conn, "readlink current", hide=True, warn=True).stdout.strip()
+    return target.removeprefix("releases/")
+
+
+def _deploy_release(conn, *, full=True):
+    """Prepare a new release in ``releases/`` next to the live one and migrate
+
+    The release is a Git worktree of the checkout with symlinks to the shared
+    ``.env``, ``media/``, ``static/`` and ``tmp/``. Its virtualenv starts as a
+    hardlinked copy of the live one and is only synced if the dependencies
+    changed (always if ``full`` is set). Nothing the running site uses is
+    modified except for the database. Returns the name of the release and
+    whether the dependencies changed.
+    """
+    run(conn, "git fetch origin")
+    rev = run(conn, f"git rev-parse origin/{config.branch}", hide=True).stdout.strip()
+    name = f"{time.strftime('%Y%m%dT%H%M%S')}-{rev[:12]}"
+    path = f"releases/{name}"
+    run(
+        conn,
+        "mkdir -p .git/info && (grep -qx /releases/ .git/info/exclude"
+        " || printf '/releases/\\n/current\\n' >> .git/info/exclude)",
+    )
+    run(conn, f"mkdir -p releases && git worktree add --detach {path} {rev}")
+    run(conn, f"cd {path} && git submodule update --init")
+    run(
+        conn,
+        " && ".join(
+            f"rm -rf {path}/{shared} && ln -s ../../{shared} {path}/{shared}"
+            for shared in _RELEASE_SHARED
+        ),
+    )
+
+    # Start from the live release or, when switching to releases, the checkout
+    previous = _current_release(conn)
+    source = f"releases/{previous}" if previous else "."
+    old = run(conn, f"git -C {source} rev-parse HEAD", hide=True).stdout.strip()
+    changed = None if full else _changed_files(conn, old, rev)
+    dependencies = _any_changed(changed, *_DEPENDENCY_FILES)
+    info(
+        f"Preparing release {name}, changed files since {previous or 'the checkout'}: "
+        + ("unknown" if changed is None else str(len(changed)))
+    )
+
+    venv = ".venv" if config._uv_project else "venv"
+    if run(conn, f"test -d {source}/{venv}", hide=True, warn=True).ok:
+        run(conn, f"cp -al {source}/{venv} {path}/{venv}")
+        # Scripts and .pth files contain absolute paths. sed replaces the
+        # files instead of writing through the hardlinks.
+        home = run(conn, "pwd", hide=True).stdout.strip()
+        old_dir = home if source == "." else f"{home}/{source}"
+        pattern = old_dir.replace(".", r"\.")
+        new_dir = f"{home}/{path}"
+        run(
+            conn,
+            f"grep -rlIZF {old_dir} {path}/{venv}/bin"
+            f" {path}/{venv}/lib/*/site-packages/*.pth 2>/dev/null"
+            f" | xargs -0 -r sed -i -e 's|{pattern}/|{new_dir}/|g'"
+            f" -e 's|{pattern}$|{new_dir}|'",
+        )
+    else:
+        dependencies = True
+        if not config._uv_project:
+            run(conn, f"cd {path} && PATH=~/.pyenv/shims:$PATH python3 -m venv venv")
+
+    with conn.cd(path):
+        if not dependencies:
+            progress("Skipping the virtualenv update, dependencies didn't change")
+        elif config._uv_project:
+            run(conn, _uv("sync --no-dev"))
+        else:
+            run(conn, "venv/bin/python -m pip install -U pip")
+            run(conn, "venv/bin/python -m pip install -r requirements.txt")
+
+        manage = (
+            _uv("run --no-dev manage.py")
+            if config._uv_project
+            else "venv/bin/python manage.py"
+        )
+        if dependencies or _any_changed(changed, "*/migrations/*.py", *_SETTINGS_FILES):
+            run(conn, f"{manage} migrate")
+        else:
+            progress("Skipping migrate, no migrations changed")
+        run(conn, f"{manage} check --deploy", warn=True)
+    return name, dependencies
+
+
+def _switch_release(conn, name):
+    """Point ``current`` to ``releases/<name>`` using an atomic rename"""
+    run(
+        conn,
+        f"ln -sfn releases/{name} current.tmp && mv -T current.tmp current"
+        f" && touch releases/{name}/.fl-released",
+    )
 
-def _deploy_staticfiles(conn):
+
+def _released(conn):
+    """Return the names of the releases which have been live, oldest first"""
+    result = run(conn, "cd releases && ls -1d */.fl-released", hide=True, warn=True)
+    return sorted(line.split("/")[0] for line in result.stdout.split())
+
+
+def _running_release(conn):
+    """Return the release the gunicorn master runs from, or ``""``
+
+    The master's interpreter stays the one it was started with, reloads
+    only replace the workers. The shebang of gunicorn's script names the
+    release's virtualenv, which shows up in the command line.
+    """
+    result = run(
+        conn,
+        f"pid=$(systemctl --user show -p MainPID --value {config.domain}.service)"
+        " && tr '\\0' ' ' < /proc/$pid/cmdline",
+        hide=True,
+        warn=True,
+    )
+    match = re.search(r"/releases/([^/\s]+)/", result.stdout)
+    return match.group(1) if match else ""
+
+
+def _prune_releases(conn):
+    """Remove all but the last ``config.releases_keep`` releases, never the
+    live one or the one gunicorn's master process runs from"""
+    releases = run(conn, "ls -1 releases", hide=True, warn=True).stdout.split()
+    keep = {_current_release(conn), _running_release(conn)}
+    old = [
+        name for name in sorted(releases)[: -config.releases_keep] if name not in keep
+    ]
+    if old:
+        run(
+            conn,
+            f"rm -rf {' '.join(f'releases/{name}' for name in old)}"
+            " && git worktree prune",
+        )
+    info(f"Removed {len(old)} old releases")
+
+
+def _deploy_staticfiles(conn, *, full=True):
+    """Collect static files; unless ``full`` is set only if static files,
+    settings or dependencies changed since the last successful run"""
+    changed = None if full else _changes_since_deployed(conn, "staticfiles")
+    if not _any_changed(changed, "*/static/*", *_SETTINGS_FILES, *_DEPENDENCY_FILES):
+        progress("Skipping collectstatic, no static files changed")
+        return
     if config._uv_project:
-        run(conn, "uv run --no-dev manage.py collectstatic --noinput")
+        run(conn, _uv("run --no-dev manage.py collectstatic --noinput"))
     else:
         run(conn, "venv/bin/python manage.py collectstatic --noinput")
+    _record_deployed(conn, "staticfiles")
 
 
 def _rsync_static(ctx, *, delete=False):
     flags = "-pthrz --stats"
     delete = " --delete" if delete else ""
     run_local(
-        ctx, f"rsync {flags}{delete} static/ {config.host}:{config.domain}/static/"
+        ctx,
+        f"rsync {flags}{delete} -e '{_ssh(config.host)}'"
+        f" static/ {config.host}:{config.domain}/static/",
     )
 
 
-@task(
-    auto_shortflags=False,
-    help={"fast": "Skip the Webpack build", "force": "Force the git push"},
-)
-def deploy(ctx, fast=False, force=False):
-    """Deploy once 🔥"""
-    _check_branch(ctx)
-    _check_no_uncommitted_changes(ctx)
-    _check_only_uv_venv_if_uv_project(ctx)
-    check(ctx)
-    force = "--force-with-lease " if (force or config.force) else ""
-    run_local(ctx, f"git push -u origin {force}{config.branch}")
-    if not fast and (config.base / "webpack.config.js").exists():
-        run_local(ctx, config.run_mise("yarn"))
-        run_local(
-            ctx,
-            f"NODE_ENV=production {config.run_mise('yarn')} run webpack --mode production --bail",
+_INCOMPRESSIBLE = {
+    ".avif",
+    ".br",
+    ".gif",
+    ".gz",
+    ".ico",
+    ".jpeg",
+    ".jpg",
+    ".mp4",
+    ".pdf",
+    ".png",
+    ".webm",
+    ".webp",
+    ".woff",
+    ".woff2",
+    ".zip",
+    ".zst",
+}
+
+
+def _static_manifest():
+    """Return ``{path: sha256}`` for all files in ``static/``
+
+    Hashes are cached in ``.cache/fl/static-manifest.json`` by size and
+    modification time.
+    """
+    cache_file = ensure_cache_dir() / "static-manifest.json"
+    try:
+        cache = json.loads(cache_file.read_text())
+    except (FileNotFoundError, ValueError):
+        cache = {}
+
+    entries = {}
+    for path in sorted(Path("static").rglob("*")):
+        if not path.is_file() or path.is_symlink():
+            continue
+        stat = path.stat()
+        name = path.relative_to("static").as_posix()
+        entry = cache.get(name)
+        if entry is None or entry[:2] != [stat.st_size, stat.st_mtime_ns]:
+            entry = [stat.st_size, stat.st_mtime_ns, _file_hash(path)]
+        entries[name] = entry
+
+    _write_if_changed(cache_file, json.dumps(entries))
+    return {name: entry[2] for name, entry in entries.items()}
+
+
+class _CountingWriter:
+    def __init__(self, stream):
+        self.stream = stream
+        self.count = 0
+
+    def write(self, data):
+        self.count += len(data)
+        return self.stream.write(data)
+
+    def flush(self):
+        self.stream.flush()
+
+
+def _ssh_command(command):
+    return f"{_ssh(config.host)} {config.host} 'cd {config.domain} && {command}'"
+
+
+def _remote_static_manifest():
+    """Return the manifest of the last upload, using the local copy in
+    ``.cache/fl/`` if it is still current"""
+    cache_file = (
+        ensure_cache_dir() / f"static-remote-{config.host}-{config.domain}.json"
+    )
+    latest = subprocess.run(
+        _ssh_command("sha256sum tmp/static-manifests/latest.json 2>/dev/null"),
+        shell=True,
+        capture_output=True,
+        text=True,
+        check=False,
+    ).stdout.split(" ")[0]
+    if not latest:
+        return {}
+    if cache_file.exists() and _file_hash(cache_file) == latest:
+        return json.loads(cache_file.read_text())
+
+    content = subprocess.run(
+        _ssh_command("cat tmp/static-manifests/latest.json"),
+        shell=True,
+        capture_output=True,
+        check=True,
+    ).stdout
+    _write_if_changed(cache_file, content.decode())
+    return json.loads(content)
+
+
+def _write_remote_static_manifest(manifest):
+    content = json.dumps(manifest, sort_keys=True)
+    name = f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}.json"
+    subprocess.run(
+        _ssh_command(
+            "mkdir -p tmp/static-manifests && cd tmp/static-manifests"
+            f" && cat > {name} && cp {name} latest.json.tmp"
+            " && mv latest.json.tmp latest.json"
+        ),
+        shell=True,
+        input=content.encode(),
+        check=True,
+    )
+    _write_if_changed(
+        ensure_cache_dir() / f"static-remote-{config.host}-{config.domain}.json",
+        content,
+    )
+
+
+def _upload_static(ctx, *, full=False):
+    """Upload files in ``static/`` which the server doesn't have yet
+
+    Compares a manifest of content hashes with the manifest of the last
+    upload and streams the missing files in two tar archives, a gzipped one
+    and one for already compressed files. ``full`` uploads all files, e.g.
+    when files have been removed on the server.
+    """
+    start = time.monotonic()
+    local = _static_manifest()
+    remote = {} if full else _remote_static_manifest()
+
+    missing = sorted(name for name, sha in local.items() if remote.get(name) != sha)
+    batches = {
+        "xzpf": [name for name in missing if Path(name).suffix not in _INCOMPRESSIBLE],
+        "xpf": [name for name in missing if Path(name).suffix in _INCOMPRESSIBLE],
+    }
+    transferred = 0
+    for flags, names in batches.items():
+        if not names:
+            continue
+        with subprocess.Popen(
+            _ssh_command(f"tar -{flags} -"), shell=True, stdin=subprocess.PIPE
+        ) as process:
+            writer = _CountingWriter(process.stdin)
+            stream = (
+                gzip.GzipFile(fileobj=writer, mode="wb", compresslevel=6)
+                if "z" in flags
+                else contextlib.nullcontext(writer)
+            )
+            with stream as fileobj, tarfile.open(fileobj=fileobj, mode="w|") as tar:
+                for name in names:
+                    tar.add(Path("static") / name, arcname=f"static/{name}")
+            process.stdin.close()
+        if process.returncode:
+            terminate(f"Uploading static files failed with status {process.returncode}")
+        transferred += writer.count
+
+    if local != remote:
+        _write_remote_static_manifest(local)
+    size = sum((Path("static") / name).stat().st_size for name in missing)
+    info(
+        f"Uploaded {len(missing)} of {len(local)} static files"
+        f" ({size / 1e6:.1f} MB, {transferred / 1e6:.1f} MB transferred)"
+        f" in {time.monotonic() - start:.1f}s"
+    )
+
+
+_GC_STATIC = """\
+import json, os, pathlib, sys
+keep = int(sys.argv[1])
+manifests = sorted(pathlib.Path("tmp/static-manifests").glob("2*.json"))
+referenced = set()
+for path in manifests[-keep:]:
+    referenced.update(json.loads(path.read_text()))
+for path in manifests[:-keep]:
+    for name in json.loads(path.read_text()).keys() - referenced:
+        try:
+            os.remove(f"static/{name}")
+            print(name)
+        except FileNotFoundError:
+            pass
+    path.unlink()
+"""
+
+
+def _gc_static(conn):
+    """Delete uploaded static files which aren't referenced by the last
+    ``config.static_manifests_keep`` manifests of ``_upload_static``
+
+    Files which weren't uploaded using manifests, e.g. those written by
+    ``collectstatic``, are never removed. Runs in one remote call.
+    """
+    deleted = run(
+        conn,
+        f"python3 -c {shlex.quote(_GC_STATIC)} {config.static_manifests_keep}",
+        hide=True,
+    ).stdout.splitlines()
+    info(f"Removed {len(deleted)} static files not referenced by recent deploys")
+    return deleted
+
+
+_PRECOMPRESS_SUFFIXES = {
+    ".css",
+    ".csv",
+    ".html",
+    ".js",
+    ".json",
+    ".map",
+    ".mjs",
+    ".svg",
+    ".txt",
+    ".wasm",
+    ".xml",
+}
+_PRECOMPRESS_MIN_SIZE = 256
+
+
+def _compress(fmt, data):
+    if fmt == "gz":
+        return gzip.compress(data, compresslevel=9, mtime=0)
+    if fmt == "br":
+        try:
+            import brotli  # noqa: PLC0415
+        except ImportError:
+            command = ["brotli", "-c", "-q", "11"]
+        else:
+            return brotli.compress(data, quality=11)
+    else:
+        try:
+            import zstandard  # noqa: PLC0415
+        except ImportError:
+            command = ["zstd", "-c", "-q", "-19"]
+        else:
+            return zstandard.ZstdCompressor(level=19).compress(data)
+    return subprocess.run(command, input=data, capture_output=True, check=True).stdout
+
+
+def _precompress_files(files, formats):
+    """Write compressed siblings of ``files`` unless they are up to date
+    and return how many were written
+
+    Siblings get the modification time of their source, which is how they
+    are recognized as up to date. Siblings which aren't smaller than their
+    source are removed.
+    """
+    written = 0
+    for file in files:
+        stat = file.stat()
+        data = None
+        for fmt in formats:
+            target = file.with_name(f"{file.name}.{fmt}")
+            with contextlib.suppress(FileNotFoundError):
+                if target.stat().st_mtime_ns == stat.st_mtime_ns:
+                    continue
+            if data is None:
+                data = file.read_bytes()
+            compressed = _compress(fmt, data)
+            if len(compressed) >= len(data):
+                with contextlib.suppress(FileNotFoundError):
+                    target.unlink()
+                continue
+            target.write_bytes(compressed)
+            os.utime(target, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            written += 1
+    return written
+
+
+def _precompress_formats():
+    formats = []
+    for fmt in config.precompress:
+        module, command = {"gz": ("gzip", None), "br": ("brotli", "brotli")}.get(
+            fmt, ("zstandard", "zstd")
         )
-    if not fast and (config.base / "rspack.config.js").exists():
-        run_local(ctx, config.run_mise("yarn"))
-        run_local(
-            ctx,
+        if importlib.util.find_spec(module) or (command and shutil.which(command)):
+            formats.append(fmt)
+        else:
+            warning(f"Not precompressing static files as .{fmt}, {module} is missing")
+    return formats
+
+
+def _precompress_static(*, jobs=None):
+    """Write ``.gz``, ``.br`` (and optionally ``.zst``) variants of the
+    compressible files in ``static/`` as configured in ``config.precompress``,
+    in a pool of threads
+
+    zlib, brotli and zstandard release the GIL while compressing, and the
+    command line fallbacks run in subprocesses. Forking isn't an option,
+    the deploy steps and paramiko run in threads.
+    """
+    if not (formats := _precompress_formats()):
+        return
+    start = time.monotonic()
+    files = [
+        path
+        for path in Path("static").rglob("*")
+        if path.suffix in _PRECOMPRESS_SUFFIXES
+        and path.is_file()
+        and path.stat().st_size >= _PRECOMPRESS_MIN_SIZE
+    ]
+
+    jobs = jobs or os.cpu_count() or 1
+    size = -(-len(files) // (jobs * 4)) or 1
+    chunks = [files[i : i + size] for i in range(0, len(files), size)]
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        written = sum(executor.map(_precompress_files, chunks, [formats] * len(chunks)))
+    info(
+        f"Wrote {written} precompressed ({', '.join(formats)}) variants of"
+        f" {len(files)} static files in {time.monotonic() - start:.1f}s"
+    )
+
+
+def _frontend_build_commands():
+    commands = []
+    if (config.base / "webpack.config.js").exists():
+        commands += [
+            config.run_mise("yarn"),
+            f"NODE_ENV=production {config.run_mise('yarn')} run webpack --mode production --bail",
+        ]
+    if (config.base / "rspack.config.js").exists():
+        commands += [
+            config.run_mise("yarn"),
             f"NODE_ENV=production {config.run_mise('yarn')} rspack build --mode production",
-        )
+        ]
+    return commands
 
-    with Connection(config.host) as conn, conn.cd(config.domain):
+
+def _frontend_build_key(commands):
+    """Hash the build commands and the tracked frontend inputs
+
+    Templates are included when Tailwind CSS is used, since it scans them
+    for class names.
+    """
+    inputs = list(config.frontend_inputs)
+    package = config.base / "package.json"
+    if package.exists() and "tailwindcss" in package.read_text(errors="replace"):
+        inputs = [spec for spec in inputs if spec != ":(exclude)*.html"]
+        inputs.append("*.html")
+    state = [commands, sorted(tracked_blobs(*inputs))]
+    return hashlib.sha256(json.dumps(state).encode()).hexdigest()
+
+
+def _static_signature():
+    # Precompressed variants are added after the build and restore.
+    return hashlib.sha256(
+        json.dumps(
+            sorted(
+                (str(path), (stat := path.stat()).st_size, stat.st_mtime_ns)
+                for path in Path("static").rglob("*")
+                if path.is_file() and path.suffix not in {".gz", ".br", ".zst"}
+            )
+        ).encode()
+    ).hexdigest()
+
+
+def _deploy_build(ctx, *, full=False):
+    """Build the frontend, or restore ``static/`` from the build cache in
+    ``.cache/fl/build/`` if the build inputs didn't change"""
+    if not (commands := _frontend_build_commands()):
+        return
+
+    cache = ensure_cache_dir(ensure_cache_dir() / "build")
+    key = _frontend_build_key(commands)
+    current = cache / "current"
+    if not full and (cache / key).is_dir():
+        os.utime(cache / key)
+        if current.exists() and current.read_text() == f"{key} {_static_signature()}":
+            progress("Skipping the frontend build, static/ is up to date")
+            return
+        progress("Restoring static/ from the build cache, inputs didn't change")
+        shutil.rmtree("static", ignore_errors=True)
+        shutil.copytree(cache / key, "static", symlinks=True)
+    else:
+        for command in commands:
+            run_local(ctx, command)
+        shutil.rmtree(cache / key, ignore_errors=True)
+        if not Path("static").is_dir():
+            return
+        shutil.copytree("static", cache / key, symlinks=True)
+        os.utime(cache / key)
+
+    current.write_text(f"{key} {_static_signature()}")
+    builds = sorted(
+        (path for path in cache.iterdir() if path.is_dir()),
+        key=lambda path: path.stat().st_mtime,
+        reverse=True,
+    )
+    for path in builds[config.build_cache_keep :]:
+        shutil.rmtree(path)
+
+
+def _deploy_steps(ctx, *, fast=False, force=False, full=False):
+    """Return the steps of ``deploy`` as ``{name: (fn, dependencies)}``"""
+    deleted = []
+    release = {}
+    warm = {}
+
+    def remote(fn):
+        def step():
+            with Connection(config.host) as conn, conn.cd(config.domain):
+                fn(conn)
+
+        return step
+
+    def django(conn):
+        start = time.monotonic()
         _deploy_sync_origin_url(ctx, conn)
-        _deploy_django(conn)
-        if not fast:
+        if config.releases:
+            release["name"], release["dependencies"] = _deploy_release(conn, full=full)
+            dependencies = release["dependencies"]
+        else:
+            dependencies = _deploy_django(conn, full=full)
+        _report_cache_warm(warm, start, updated=dependencies)
+
+    def clean_static(conn):
+        deleted.extend(
             run(
                 conn,
-                "if [ -e static ]; then find static/ -type f -mtime +60 -delete;fi",
+                "if [ -e static ]; then find static/ -type f -mtime +60 -print -delete;fi",
+                hide=True,
+            ).stdout.splitlines()
+        )
+        if deleted:
+            info(f"Removed {len(deleted)} files older than 60 days from static/")
+
+    def gc_static(conn):
+        deleted.extend(_gc_static(conn))
+
+    def staticfiles(conn):
+        # Collected files may have been removed too, collect them again then.
+        with (
+            conn.cd(f"releases/{release['name']}")
+            if config.releases
+            else contextlib.nullcontext()
+        ):
+            _deploy_staticfiles(conn, full=full or bool(deleted))
+
+    def restart(conn):
+        if not config.releases:
+            _nine_restart(conn)
+            return
+        _switch_release(conn, release["name"])
+        # Workers forked by a reload would still use the old virtualenv.
+        _nine_restart(conn, reload=not release["dependencies"])
+
+    force = "--force-with-lease " if (force or config.force) else ""
+    steps = {
+        "check": (lambda: check(ctx), []),
+        "push": (
+            lambda: run_local(ctx, f"git push -u origin {force}{config.branch}"),
+            ["check"],
+        ),
+        "django": (remote(django), ["push"]),
+        "staticfiles": (
+            remote(staticfiles),
+            ["django"] if fast else ["django", "upload_static"],
+        ),
+        "restart": (remote(restart), ["staticfiles"]),
+        "fetch": (lambda: fetch(ctx), ["django"]),
+    }
+    if config.releases:
+        steps["prune_releases"] = (remote(_prune_releases), ["restart"])
+    if config._uv_project:
+        # Only writes to tmp/cache-warm/ and the uv cache, so it starts
+        # before the push. django doesn't wait for it, uv locks the cache
+        # entries being written.
+        steps["cache_warm"] = (lambda: _cache_warm_step(ctx, warm), ["check"])
+    # prek stashes unstaged changes, so the build waits for the check. Steps
+    # which change the server wait until the pushed code passed the check.
+    if not fast and config.static_upload == "rsync":
+        steps |= {
+            "build": (lambda: _deploy_build(ctx, full=full), ["check"]),
+            "precompress": (_precompress_static, ["build"]),
+            "clean_static": (remote(clean_static), ["push"]),
+            "upload_static": (
+                lambda: _rsync_static(ctx, delete=False),
+                ["precompress", "clean_static"],
+            ),
+        }
+    elif not fast:
+        steps |= {
+            "build": (lambda: _deploy_build(ctx, full=full), ["check"]),
+            "precompress": (_precompress_static, ["build"]),
+            "upload_static": (
+                lambda: _upload_static(ctx, full=full),
+                ["precompress", "push"],
+            ),
+            "gc_static": (remote(gc_static), ["upload_static"]),
+        }
+        steps["staticfiles"][1].append("gc_static")
+    return steps
+
+
+def _traced_step(name, fn):
+    with _traced(name, "step"):
+        return fn()
+
+
+def _run_steps(steps):
+    """Run ``{name: (fn, dependencies)}``, every step in its own thread as
+    soon as its dependencies have finished
+
+    After the first exception (including the ``SystemExit`` raised by
+    ``terminate``) no further steps are started; the exception is raised
+    again when the running steps have finished.
+    """
+    if unknown := {dep for _, deps in steps.values() for dep in deps} - steps.keys():
+        terminate(f"Unknown steps: {', '.join(sorted(unknown))}")
+
+    done = set()
+    running = {}
+    error = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(steps) or 1) as pool:
+        while True:
+            if error is None:
+                for name, (fn, deps) in steps.items():
+                    if (
+                        name not in done
+                        and name not in running.values()
+                        and done.issuperset(deps)
+                    ):
+                        running[pool.submit(_traced_step, name, fn)] = name
+            if not running:
+                break
+            finished, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
             )
-            _rsync_static(ctx, delete=False)
-        _deploy_staticfiles(conn)
-        _nine_restart(conn)
+            for future in finished:
+                name = running.pop(future)
+                if (exc := future.exception()) is not None:
+                    error = error or exc
+                else:
+                    done.add(name)
 
-    fetch(ctx)
+    if error is not None:
+        raise error
+    if pending := steps.keys() - done:
+        terminate(f"Circular dependencies between steps: {', '.join(sorted(pending))}")
+
+
+@task(
+    auto_shortflags=False,
+    help={
+        "fast": "Skip the Webpack build",
+        "force": "Force the git push",
+        "full": "Run all steps, even those whose inputs didn't change",
+    },
+)
+def deploy(ctx, fast=False, force=False, full=False):
+    """Deploy once 🔥"""
+    _check_branch(ctx)
+    _check_server(ctx)
+    _run_steps(_deploy_steps(ctx, fast=fast, force=force, full=full))
     progress(f"Successfully deployed the {config.environment} environment.")
 
 
+@task(
+    auto_shortflags=False,
+    help={"release": "Release to switch to, defaults to the previous one"},
+)
+def rollback(ctx, release=""):
+    """Switch back to the previous release"""
+    if not config.releases:
+        terminate("Rollbacks need config.releases")
+    with Connection(config.host) as conn, conn.cd(config.domain):
+        released = _released(conn)
+        current = _current_release(conn)
+        if not release:
+            if not (earlier := [name for name in released if name < current]):
+                terminate(f"There is no release before {current}")
+            release = earlier[-1]
+        elif release not in released:
+            terminate(f"Unknown release '{release}', known: {', '.join(released)}")
+        _switch_release(conn, release)
+        _nine_restart(conn, reload=False)
+    progress(f"Switched back to {release}. Migrations haven't been reverted!")
+
+
 @task
 def audit(ctx):
     """Run various package auditing tools"""
@@ -1098,6 +2752,117 @@ def audit(ctx):
         progress(f"yarn lockfile {yarn_lock} doesn't exist")
 
 
+def _fan_out_argv(task_name, *own):
+    """Return the command line before and after the tokens of ``task_name``
+
+    ``own`` are the values of positional arguments of the task, ``--jobs``
+    is skipped as well.
+    """
+    argv = sys.argv[1:]
+    index = argv.index(task_name)
+    own = list(own)
+    rest = argv[index + 1 :]
+    while rest:
+        if rest[0] == "--jobs":
+            rest = rest[2:]
+        elif rest[0].startswith("--jobs="):
+            rest = rest[1:]
+        elif own and rest[0] == own[0]:
+            own.pop(0)
+            rest = rest[1:]
+        else:
+            break
+    return argv[:index], rest
+
+
+# Tasks which use the working tree (prek's stash, the frontend build,
+# static/ and the local caches) and cannot run in several processes at once.
+_WORKING_TREE_TASKS = {"check", "deploy"}
+
+
+def _fan_out(environments, *, core, rest, jobs):
+    """Run ``fl <environment> <rest>`` for all environments in subprocesses,
+    at most ``jobs`` at once, prefix their output and exit with a summary
+
+    Environments are processed one at a time if ``rest`` contains one of the
+    ``_WORKING_TREE_TASKS``.
+    """
+    environments = [_environment_aliases.get(name, name) for name in environments]
+    if unknown := [name for name in environments if name not in config.environments]:
+        terminate(f"Unknown environments: {', '.join(unknown)}")
+    if not rest:
+        terminate("Which tasks should run in the environments?")
+    if int(jobs) > 1 and (tasks := _WORKING_TREE_TASKS.intersection(rest)):
+        warning(
+            "Running one environment at a time because of"
+            f" {', '.join(sorted(tasks))}, which use the working tree."
+        )
+        jobs = 1
+    fl = sys.argv[0] if os.access(sys.argv[0], os.X_OK) else "fl"
+
+    def run_one(name):
+        env = dict(os.environ)
+        if _TRACE:
+            trace = Path(_TRACE)
+            env["FL_TRACE"] = str(trace.with_name(f"{trace.stem}-{name}{trace.suffix}"))
+        start = time.monotonic()
+        with subprocess.Popen(
+            [fl, *core, name, *rest],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            env=env,
+            text=True,
+            errors="replace",
+        ) as process:
+            stream = _PrefixedStream(f"[{name}] ", sys.stdout)
+            for line in process.stdout:
+                stream.write(line)
+            stream.close()
+        return process.returncode, time.monotonic() - start
+
+    progress(f"Running '{' '.join(rest)}' in {', '.join(environments)}...")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=int(jobs)) as pool:
+        results = dict(zip(environments, pool.map(run_one, environments)))
+
+    print()
+    for name, (returncode, duration) in results.items():
+        if returncode:
+            warning(f"{name}: failed with status {returncode} after {duration:.1f}s")
+        else:
+            info(f"{name}: succeeded in {duration:.1f}s")
+    if failed := [name for name, (returncode, _) in results.items() if returncode]:
+        terminate(f"Failed in {len(failed)} of {len(results)} environments.")
+    # The remaining tasks ran in the subprocesses already.
+    sys.exit(0)
+
+
+@task(
+    name="all",
+    auto_shortflags=False,
+    help={"jobs": "Number of environments to run at once (default: 4)"},
+)
+def all_environments(ctx, jobs=4):
+    """Run the following tasks in all environments, e.g. fl all deploy"""
+    core, rest = _fan_out_argv("all")
+    _fan_out(list(config.environments), core=core, rest=rest, jobs=jobs)
+
+
+@task(
+    auto_shortflags=False,
+    positional=["names"],
+    help={
+        "names": "Comma-separated environment names",
+        "jobs": "Number of environments to run at once (default: 4)",
+    },
+)
+def envs(ctx, names, jobs=4):
+    """Run the following tasks in several environments, e.g. fl envs
+    production,next nine-restart"""
+    core, rest = _fan_out_argv("envs", names)
+    _fan_out(names.split(","), core=core, rest=rest, jobs=jobs)
+
+
 GENERAL = {
     hook,
     cm,
@@ -1113,6 +2878,8 @@ GENERAL = {
     check,
     debug,
     audit,
+    all_environments,
+    envs,
 }
 NINE = {
     nine_vhost,
@@ -1125,10 +2892,12 @@ NINE = {
     nine_disable,
     nine_checkout,
     nine_venv,
+    nine_cache_warm,
     nine_reinit_from,
     nine,
     pull_db,
     pull_media,
     fetch,
     deploy,
+    rollback,
 }
@@ -11,14 +11,27 @@ Run tests::
 
 """
 
+import hashlib
+import json
+import multiprocessing
+import os
 import re
 import subprocess
-from collections import deque
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+
+JS_PATTERNS = ["*.js", "*.mjs", "*.jsx", "*.ts", "*.tsx"]
+CACHE_DIR = Path(".cache") / "fl"
+#: Below this many files to parse, starting worker processes costs more than
+#: it saves.
+PARALLEL_THRESHOLD = 200
 
 
 def js_files():
     res = subprocess.run(
-        ["git", "ls-files", "*.js", "*.mjs", "*.jsx", "*.ts", "*.tsx"],
+        ["git", "ls-files", *JS_PATTERNS],
         capture_output=True,
         encoding="utf-8",
         check=True,
@@ -26,6 +39,202 @@ def js_files():
     return res.stdout.splitlines()
 
 
+def tracked_blobs(*pathspecs):
+    """Return ``(blob, path)`` tuples for tracked files
+
+    The blob is the git object hash of the file's current content: files
+    without local modifications take it from the index, modified files are
+    hashed as they are in the working tree. Deleted files are skipped.
+    """
+
+    def git(*args, **kwargs):
+        return subprocess.run(
+            ["git", *args], capture_output=True, encoding="utf-8", check=True, **kwargs
+        ).stdout
+
+    blobs = {}
+    for line in git("ls-files", "-s", "-z", "--", *pathspecs).split("\0"):
+        if line:
+            info, path = line.split("\t", 1)
+            blobs[path] = info.split()[1]
+
+    modified = [
+        path
+        for path in git("ls-files", "-m", "-z", "--", *pathspecs).split("\0")
+        if path in blobs
+    ]
+    for path in modified:
+        if not os.path.exists(path):
+            del blobs[path]
+    if modified := [path for path in modified if path in blobs]:
+        hashes = git("hash-object", "--stdin-paths", input="\n".join(modified))
+        blobs.update(zip(modified, hashes.split()))
+
+    return [(blob, path) for path, blob in blobs.items()]
+
+
+_STRING = {
+    "'": re.compile(r"'(?:[^'\\\n]|\\[\s\S])*'?"),
+    '"': re.compile(r'"(?:[^"\\\n]|\\[\s\S])*"?'),
+}
+_TEMPLATE_BODY = re.compile(r"(?:[^`\\$]|\\[\s\S]|\$(?!\{))*(?:`|\$\{|\\?\Z)")
+_REGEX_LITERAL = re.compile(r"/(?:[^/\\\[\n]|\\.|\[(?:[^\]\\\n]|\\.)*\])+/")
+_WHITESPACE = re.compile(r"\s*")
+# Patterns for finding the next interesting character, keyed by whether
+# parentheses (a call is pending) or braces (the scanner is inside a template
+# literal substitution) are interesting at the moment.
+_SEARCH = {
+    (False, False): re.compile(r"[/'\"`]|gettext(?![\w$])").search,
+    (True, False): re.compile(r"[/'\"`()]|gettext(?![\w$])").search,
+    (False, True): re.compile(r"[/'\"`{}]|gettext(?![\w$])").search,
+    (True, True): re.compile(r"[/'\"`(){}]|gettext(?![\w$])").search,
+}
+# Keywords after which an expression starts, so a slash starts a regular
+# expression (not a division) and a quote a string (not JSX text).
+_EXPRESSION_KEYWORDS = {
+    "await",
+    "case",
+    "delete",
+    "do",
+    "else",
+    "in",
+    "instanceof",
+    "new",
+    "of",
+    "return",
+    "throw",
+    "typeof",
+    "void",
+    "yield",
+}
+
+
+def _slash_starts_regex(source, idx):
+    idx -= 1
+    while idx >= 0 and source[idx].isspace():
+        idx -= 1
+    if idx < 0:
+        return True
+    # ``</`` is a JSX closing tag.
+    if source[idx] in ")]}'\"`<":
+        return False
+    # ``a++ / 2``
+    if source[idx] in "+-" and source[idx - 1 : idx] == source[idx]:
+        return False
+    if source[idx].isalnum() or source[idx] in "_$":
+        return _identifier(source, idx, idx + 1) in _EXPRESSION_KEYWORDS
+    return True
+
+
+def _quote_starts_string(source, idx):
+    # A quote directly after a word is an apostrophe in JSX text such as
+    # ``<p>Don't</p>``, except after keywords (``return"x"`` when minified).
+    if idx and (source[idx - 1].isalnum() or source[idx - 1] in "_$"):
+        return _identifier(source, idx - 1, idx) in _EXPRESSION_KEYWORDS
+    return True
+
+
+def _identifier(source, start, end):
+    """Return the identifier ending at ``end``"""
+    while start and (source[start - 1].isalnum() or source[start - 1] in "_$"):
+        start -= 1
+    return source[start:end]
+
+
+def _without(source, start, end, skips):
+    """Return ``source[start:end]`` without the ``(start, end)`` spans in
+    ``skips``"""
+    pieces = []
+    for skip_start, skip_end in skips:
+        pieces.append(source[start:skip_start])
+        start = skip_end
+    pieces.append(source[start:end])
+    return "".join(pieces)
+
+
+def _comment_end(source, start):
+    if source[start + 1] == "/":
+        end = source.find("\n", start + 2)
+        return len(source) if end == -1 else end
+    end = source.find("*/", start + 2)
+    return len(source) if end == -1 else end + 2
+
+
+def _literal_end(source, start, braces):
+    """Return the end of the string, template or regular expression literal
+    starting at ``start``, or of the division operator or brace"""
+    c = source[start]
+    if c in _STRING:
+        if not _quote_starts_string(source, start):
+            return start + 1
+        return _STRING[c].match(source, start).end()
+    if c == "/":
+        if _slash_starts_regex(source, start) and (
+            regex := _REGEX_LITERAL.match(source, start)
+        ):
+            return regex.end()
+    elif c == "{":
+        braces.append(False)
+    elif c == "`" or braces.pop():
+        end = _TEMPLATE_BODY.match(source, start + 1).end()
+        if source.endswith("${", 0, end):
+            braces.append(True)
+        return end
+    return start + 1
+
+
+def _scan(source):
+    """Yield ``("comment", start, end)`` for comments and ``("call", name,
+    args)`` for ``*gettext`` calls in JavaScript source
+
+    This is a single pass over the source. String, template and regular
+    expression literals are skipped, including code nested in template
+    literals using ``${...}``.
+    """
+    braces = []  # True for a template literal substitution
+    name = None  # *gettext identifier, maybe followed by a call
+    call = None  # Start of the current call's arguments
+    after = depth = pos = 0
+    skips = []
+
+    while m := _SEARCH[name is not None or call is not None, bool(braces)](source, pos):
+        start, pos = m.span()
+        c = source[start]
+
+        if c == "/" and source.startswith(("//", "/*"), start):
+            pos = _comment_end(source, start)
+            yield "comment", start, pos
+            if call is not None:
+                skips.append((start, pos))
+            elif name and _WHITESPACE.fullmatch(source, after, start):
+                after = pos
+            continue
+
+        if c == "g":
+            # A nested call abandons the call it's nested in, xgettext
+            # couldn't extract the outer call anyway.
+            call = None
+            name = _identifier(source, start, pos).rpartition("$")[2]
+            after = pos
+            continue
+
+        if c == "(":
+            if call is not None:
+                depth += 1
+            elif name and _WHITESPACE.fullmatch(source, after, start):
+                call, call_name, depth, skips = pos, name, 0, []
+        elif c == ")":
+            if depth:
+                depth -= 1
+            elif call is not None:
+                yield "call", call_name, _without(source, call, start, skips)
+                call = None
+        else:
+            pos = _literal_end(source, start, braces)
+
+        name = None
+
+
 def strip_comments(source):
     """Remove JavaScript comments, leaving string literals alone
 
@@ -39,60 +248,17 @@ def strip_comments(source):
     "gettext('a /* not a comment */ b')"
     >>> strip_comments("gettext('it\\\\'s') // x")
     "gettext('it\\\\'s') "
+    >>> strip_comments("x = `abc\\\\")
+    'x = `abc\\\\'
     """
-    out = []
-    quote = ""
-    idx = 0
-    length = len(source)
-
-    while idx < length:
-        c = source[idx]
-
-        if quote:
-            out.append(c)
-            if c == "\\" and idx + 1 < length:
-                out.append(source[idx + 1])
-                idx += 2
-                continue
-            if c == quote:
-                quote = ""
-            idx += 1
-        elif c in {"'", '"', "`"}:
-            quote = c
-            out.append(c)
-            idx += 1
-        elif c == "/" and source[idx + 1 : idx + 2] == "/":
-            while idx < length and source[idx] != "\n":
-                idx += 1
-        elif c == "/" and source[idx + 1 : idx + 2] == "*":
-            end = source.find("*/", idx + 2)
-            idx = length if end == -1 else end + 2
-        else:
-            out.append(c)
-            idx += 1
-
-    return "".join(out)
-
-
-def extract_args(part):
-    parens = 0
-    quote = ""
-    for idx, c in enumerate(part):
-        if c == quote:
-            quote = ""
-        elif quote:
-            pass
-        elif c in {"'", '"', "`"}:
-            quote = c
-        elif c == "(":
-            parens += 1
-        elif c == ")":
-            parens -= 1
-
-        if parens == 0:
-            return part[1:idx]
-
-    return ""
+    pieces = []
+    last = 0
+    for kind, start, end in _scan(source):
+        if kind == "comment":
+            pieces.append(source[last:start])
+            last = end
+    pieces.append(source[last:])
+    return "".join(pieces)
 
 
 def gettext_calls(source):
@@ -140,32 +306,319 @@ def gettext_calls(source):
     []
     >>> list(gettext_calls("gettext(someVariable)"))
     []
-    """
 
-    parts = deque(
-        part.strip() for part in re.split(r"\b(\w*gettext)\b", strip_comments(source))
-    )
+    Strings, template literals (including nested code) and regular
+    expression literals are skipped properly:
 
-    while parts:
-        top = parts.popleft()
-        if not top.endswith("gettext"):
-            continue
+    >>> list(gettext_calls("const s = 'gettext(\\\\'nope\\\\')'; gettext('yes')"))
+    ["gettext('yes')"]
+    >>> list(gettext_calls("x = `${gettext('a')} ${ {b: `)`}.b }`; gettext('c')"))
+    ["gettext('a')", "gettext('c')"]
+    >>> list(gettext_calls("if (/['(]/.test(s)) gettext('a'); x = a / 2 / gettext('b')"))
+    ["gettext('a')", "gettext('b')"]
+    >>> list(gettext_calls("gettext('a' /* comment */)"))
+    ["gettext('a')"]
+    >>> list(gettext_calls("<b>{gettext('Save')}</b> <i>{gettext('Cancel')}</i>"))
+    ["gettext('Save')", "gettext('Cancel')"]
+    >>> list(gettext_calls("gettext('a'); x = `abc\\\\"))
+    ["gettext('a')"]
+    >>> list(gettext_calls("x = a++ / 2; gettext('m') / 3"))
+    ["gettext('m')"]
+    >>> list(gettext_calls("<p>Don't panic {gettext('Save')}</p>"))
+    ["gettext('Save')"]
+    >>> list(gettext_calls('function f(){return"x"+gettext("y")}'))
+    ['gettext("y")']
+    """
 
-        if parts and (args := extract_args(parts.popleft())):
-            args = args.strip().rstrip(",")
+    for kind, name, value in _scan(source):
+        if kind == "call":
+            args = value.strip().rstrip(",")
             # xgettext only ever sees literals, so anything else -- a variable,
             # or the parameter list of a TypeScript declaration -- is noise.
             if args[:1] in {"'", '"', "`"}:
-                yield f"{top}({args})"
+                yield f"{name}({args})"
+
+
+def candidate_files(*pathspecs):
+    """Return the set of tracked files which contain ``gettext`` at all
+
+    ``git grep`` is much cheaper than reading and parsing each file in
+    Python, and most files do not contain any translatable strings.
+    """
+    res = subprocess.run(
+        ["git", "grep", "-l", "-z", "-F", "-e", "gettext", "--", *pathspecs],
+        check=False,
+        capture_output=True,
+        encoding="utf-8",
+    )
+    # git grep exits with 1 if nothing matched.
+    if res.returncode > 1:
+        raise subprocess.CalledProcessError(res.returncode, res.args, res.stdout)
+    return set(filter(None, res.stdout.split("\0")))
+
+
+def _cache_version():
+    # Any change to the extractor invalidates all cached results.
+    return hashlib.sha1(Path(__file__).read_bytes()).hexdigest()
+
+
+def _read_cache(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(data, dict) or data.get("version") != _cache_version():
+        return {}
+    return data.get("calls") or {}
+
+
+def ensure_cache_dir(path=CACHE_DIR):
+    """Create the cache folder, hidden from git, and return its path"""
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    if not (gitignore := path / ".gitignore").exists():
+        gitignore.write_text("*\n")
+    return path
+
 
+def _write_cache(path, calls):
+    path = Path(path)
+    ensure_cache_dir(path.parent)
+    with tempfile.NamedTemporaryFile(
+        "w", encoding="utf-8", dir=path.parent, delete=False
+    ) as f:
+        json.dump({"version": _cache_version(), "calls": calls}, f)
+    os.replace(f.name, path)
 
-def generate_strings():
-    calls = set()
-    for file in js_files():
-        with open(file, encoding="utf-8") as f:
-            calls |= set(gettext_calls(f.read()))
+
+def file_calls(file):
+    """Return the sorted, unique gettext calls in a file"""
+    with open(file, "rb") as f:
+        data = f.read()
+    if b"gettext" not in data:
+        return []
+    return sorted(set(gettext_calls(data.decode("utf-8"))))
+
+
+def _files_calls(files):
+    return [file_calls(file) for file in files]
+
+
+def parse_files(files, *, jobs=None):
+    """Return the result of ``file_calls`` for each file, in order
+
+    Large batches are split into chunks and parsed in a pool of ``jobs``
+    worker processes (default: one per CPU). Small batches and ``jobs=1``
+    are parsed serially.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    if (
+        jobs == 1
+        or len(files) < PARALLEL_THRESHOLD
+        # Workers are forked; re-importing fh_fablib in a fresh interpreter
+        # isn't possible outside of a fabfile.
+        or "fork" not in multiprocessing.get_all_start_methods()
+    ):
+        return _files_calls(files)
+
+    size = -(-len(files) // (jobs * 4))
+    chunks = [files[i : i + size] for i in range(0, len(files), size)]
+    with ProcessPoolExecutor(
+        jobs, mp_context=multiprocessing.get_context("fork")
+    ) as executor:
+        return [
+            found for chunk in executor.map(_files_calls, chunks) for found in chunk
+        ]
+
+
+def calls_by_file(*, cache=CACHE_DIR / "gettext-calls.json", jobs=None):
+    """Return a ``{path: calls}`` dict for all tracked JS/TS files
+
+    Results are cached per git blob in ``cache`` (pass ``None`` to disable
+    the cache) so that only new or changed files have to be parsed again.
+    Entries for blobs which aren't tracked anymore are evicted. Files which
+    do not contain ``gettext`` at all are skipped, the rest is parsed using
+    ``parse_files``.
+    """
+    cached = _read_cache(cache) if cache else {}
+    candidates = candidate_files(*JS_PATTERNS)
+    files = {}
+    entries = {}
+    missing = {}
+    for blob, file in tracked_blobs(*JS_PATTERNS):
+        if file not in candidates:
+            continue
+        files[file] = blob
+        if blob in cached:
+            entries[blob] = cached[blob]
+        else:
+            missing.setdefault(blob, file)
+
+    entries.update(zip(missing, parse_files(list(missing.values()), jobs=jobs)))
+
+    if cache and entries != cached:
+        _write_cache(cache, entries)
+
+    return {file: entries[blob] for file, blob in files.items()}
+
+
+def sort_calls(calls):
     return sorted(calls, key=lambda c: (c.lower(), c))
 
 
+def generate_strings(*, cache=CACHE_DIR / "gettext-calls.json", jobs=None):
+    """Return the sorted list of gettext calls in all tracked JS/TS files"""
+    by_file = calls_by_file(cache=cache, jobs=jobs)
+    return sort_calls({call for calls in by_file.values() for call in calls})
+
+
+_LITERAL = re.compile(
+    r"""\s*(?:'((?:[^'\\]|\\[\s\S])*)'|"((?:[^"\\]|\\[\s\S])*)"|`((?:[^`\\$]|\\[\s\S]|\$(?!\{))*)`)\s*"""
+)
+_ESCAPE = re.compile(
+    r"\\(u\{[0-9a-fA-F]+\}|u[0-9a-fA-F]{4}|x[0-9a-fA-F]{2}|\r\n|[\s\S])"
+)
+_ESCAPES = {"b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t", "v": "\v", "0": "\0"}
+# Keywords understood by Django's JavaScript catalog and whether they take
+# a context and a plural.
+KEYWORDS = {
+    "gettext": (False, False),
+    "ngettext": (False, True),
+    "pgettext": (True, False),
+    "npgettext": (True, True),
+}
+
+
+def _unescape(match):
+    escape = match.group(1)
+    if escape[0] in "ux" and len(escape) > 1:
+        return chr(int(escape.strip("ux{}"), 16))
+    if escape in {"\n", "\r", "\r\n", "\u2028", "\u2029"}:
+        return ""  # Line continuation
+    return _ESCAPES.get(escape, escape)
+
+
+def _string_arguments(args):
+    """Return the values of the leading string literal arguments
+
+    Literals concatenated with ``+`` are joined.
+    """
+    strings = []
+    value = None
+    pos = 0
+    while m := _LITERAL.match(args, pos):
+        literal = next(group for group in m.groups() if group is not None)
+        value = (value or "") + _ESCAPE.sub(_unescape, literal)
+        pos = m.end()
+        if args.startswith("+", pos):
+            pos += 1
+            continue
+        strings.append(value)
+        value = None
+        if not args.startswith(",", pos):
+            break
+        pos += 1
+    return strings
+
+
+def message(call):
+    """Return ``(context, singular, plural)`` for a gettext call as returned
+    by ``gettext_calls``, or ``None`` if xgettext wouldn't extract it
+
+    >>> message("gettext('abc')")
+    (None, 'abc', None)
+    >>> message("npgettext('month', 'one', \\"many\\", n)")
+    ('month', 'one', 'many')
+    >>> message("ngettext('it\\\\'s ' + `one`, 'many\\\\n', n)")
+    (None, "it's one", 'many\\n')
+    >>> message("pgettext('ctx', variable)") is None
+    True
+    >>> message("mygettext('abc')") is None
+    True
+    """
+    name, _, args = call.partition("(")
+    if name not in KEYWORDS:
+        return None
+    context, plural = KEYWORDS[name]
+    strings = _string_arguments(args[:-1])
+    if len(strings) < 1 + context + plural:
+        return None
+    return (
+        strings.pop(0) if context else None,
+        strings[0],
+        strings[1] if plural else None,
+    )
+
+
+def _po_string(value):
+    value = (
+        value.replace("\\", "\\\\")
+        .replace('"', '\\"')
+        .replace("\t", "\\t")
+        .replace("\r", "\\r")
+    )
+    if "\n" not in value[:-1]:
+        return '"{}"'.format(value.replace("\n", "\\n"))
+    lines = value.splitlines(keepends=True)
+    return '""\n' + "\n".join(
+        '"{}"'.format(line.replace("\n", "\\n")) for line in lines
+    )
+
+
+def generate_pot(by_file, *, creation_date):
+    """Return the content of a POT file for the calls in ``{path: calls}``
+
+    Messages are sorted by the first file they appear in. Locations only
+    contain file names, the same as ``makemessages --add-location file``.
+    """
+    messages = {}
+    for path in sorted(by_file):
+        for call in by_file[path]:
+            # An empty msgid would clash with the header entry.
+            if (parsed := message(call)) and parsed[1]:
+                messages.setdefault(parsed, []).append(path)
+
+    entries = [
+        f"""\
+# SOME DESCRIPTIVE TITLE.
+# Copyright (C) YEAR THE PACKAGE'S COPYRIGHT HOLDER
+# This file is distributed under the same license as the PACKAGE package.
+# FIRST AUTHOR <EMAIL@ADDRESS>, YEAR.
+#
+#, fuzzy
+msgid ""
+msgstr ""
+"Project-Id-Version: PACKAGE VERSION\\n"
+"Report-Msgid-Bugs-To: \\n"
+"POT-Creation-Date: {creation_date}\\n"
+"PO-Revision-Date: YEAR-MO-DA HO:MI+ZONE\\n"
+"Last-Translator: FULL NAME <EMAIL@ADDRESS>\\n"
+"Language-Team: LANGUAGE <LL@li.org>\\n"
+"Language: \\n"
+"MIME-Version: 1.0\\n"
+"Content-Type: text/plain; charset=UTF-8\\n"
+"Content-Transfer-Encoding: 8bit\\n"
+"""
+    ]
+    if any(plural is not None for _, _, plural in messages):
+        # Like xgettext, replaced when a catalog is created.
+        entries[0] += '"Plural-Forms: nplurals=INTEGER; plural=EXPRESSION;\\n"\n'
+    for (context, singular, plural), paths in messages.items():
+        entry = [f"#: {' '.join(paths)}"]
+        if re.search(r"%(?:\(\w+\))?[sd]", singular + (plural or "")):
+            entry.append("#, javascript-format")
+        if context is not None:
+            entry.append(f"msgctxt {_po_string(context)}")
+        entry.append(f"msgid {_po_string(singular)}")
+        if plural is None:
+            entry.append('msgstr ""')
+        else:
+            entry.append(f"msgid_plural {_po_string(plural)}")
+            entry.extend(('msgstr[0] ""', 'msgstr[1] ""'))
+        entries.append("\n".join(entry) + "\n")
+    return "\n".join(entries)
+
+
 if __name__ == "__main__":
     print(generate_strings())